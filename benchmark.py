@@ -0,0 +1,242 @@
+from openpyxl import Workbook
+from scipy.linalg import block_diag
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+import multiprocessing
+import numpy as np
+import subprocess
+import argparse
+import datetime
+import platform
+import tempfile
+import json
+import os
+
+import single
+
+# Synthetic instance sizes of each task, from the size of the bundled workbooks upwards
+SIZES = {
+    'task1': [
+        {'suppliers': 5, 'materials': 4, 'factories': 3, 'products': 4, 'customers': 4},
+        {'suppliers': 20, 'materials': 10, 'factories': 5, 'products': 10, 'customers': 100},
+        {'suppliers': 50, 'materials': 20, 'factories': 10, 'products': 20, 'customers': 500},
+    ],
+    'task2': [
+        {'towns': 10},
+        {'towns': 20},
+        {'towns': 40},
+    ],
+    'task3': [
+        {'assets': 8, 'months': 61},
+        {'assets': 50, 'months': 120},
+        {'assets': 200, 'months': 240},
+    ],
+}
+
+def write_workbook(path, sheets):
+    # sheets maps a sheet name to (corner cell, row labels, column labels, values)
+    xlsx_file = Workbook(write_only= True)
+    for name, (corner, rows, cols, values) in sheets.items():
+        sheet = xlsx_file.create_sheet(name)
+        sheet.append([corner] + list(cols))
+        for row, row_values in zip(rows, values.tolist()):
+            sheet.append([row] + [value if value != 0 else None for value in row_values])
+    xlsx_file.save(path)
+
+def make_supply_chain(path, suppliers, materials, factories, products, customers, seed= 0, density= 0.5):
+    # A random task1 workbook that always has a feasible solution: every product can be made in at least
+    # one factory, the capacities cover the demand and the suppliers stock more than the demand needs
+    rng = np.random.default_rng(seed)
+    supplier_labels = [f'Supplier {i:04d}' for i in range(suppliers)]
+    material_labels = [f'Material {i:04d}' for i in range(materials)]
+    factory_labels = [f'Factory {i:04d}' for i in range(factories)]
+    product_labels = [f'Product {i:04d}' for i in range(products)]
+    customer_labels = [f'Customer {i:04d}' for i in range(customers)]
+
+    customer_demand = rng.integers(1, 10, (products, customers)) * (rng.random((products, customers)) < density)
+    prod_req = rng.integers(1, 6, (products, materials)) * (rng.random((products, materials)) < density)
+    prod_req[np.arange(products), rng.integers(0, materials, products)] = rng.integers(1, 6, products)
+
+    can_make = rng.random((products, factories)) < density
+    can_make[np.arange(products), rng.integers(0, factories, products)] = True
+    prod_cap = np.ceil(1.5 * customer_demand.sum(axis= 1, keepdims= True) / can_make.sum(axis= 1, keepdims= True)).astype(int) * can_make
+
+    in_stock = rng.random((suppliers, materials)) < density
+    in_stock[rng.integers(0, suppliers, materials), np.arange(materials)] = True
+    material_need = (customer_demand.sum(axis= 1) @ prod_req)[None, :]
+    supplier_stock = np.ceil(1.5 * material_need / in_stock.sum(axis= 0, keepdims= True)).astype(int) * in_stock
+
+    write_workbook(path, {
+        'Supplier stock': (None, supplier_labels, material_labels, supplier_stock),
+        'Raw material costs': (None, supplier_labels, material_labels, rng.integers(10, 100, (suppliers, materials)) * in_stock),
+        'Raw material shipping': (None, supplier_labels, factory_labels, rng.integers(5, 50, (suppliers, factories))),
+        'Product requirements': (None, product_labels, material_labels, prod_req),
+        'Production capacity': (None, product_labels, factory_labels, prod_cap),
+        'Production cost': (None, product_labels, factory_labels, rng.integers(50, 200, (products, factories)) * can_make),
+        'Customer demand': (None, product_labels, customer_labels, customer_demand),
+        'Shipping costs': (None, factory_labels, customer_labels, rng.integers(10, 100, (factories, customers))),
+    })
+
+def make_decomposable_supply_chain(workdir, groups, size, seed= 0):
+    # `groups` random supply chains of the given size side by side in one Task1Data: the sheets of the groups
+    # are the diagonal blocks, and shipping between two groups costs as much as the dearest lane within one
+    parts = []
+    for k in range(groups):
+        path = os.path.join(workdir, f'group{k}.xlsx')
+        make_supply_chain(path, seed= seed + k, **size)
+        parts.append(single.load_task1_data(path))
+
+    merged = {name: [f'{label} g{k}' for k, part in enumerate(parts) for label in getattr(part, name)]
+              for name in ['suppliers', 'materials', 'factories', 'products', 'customers']}
+    for name in single.TASK1_LABELS:
+        blocks = [getattr(part, name) for part in parts]
+        merged[name] = block_diag(*blocks)
+        if name in ('raw_mat_ship', 'ship_cost'):
+            inside = block_diag(*[np.ones(block.shape, dtype= bool) for block in blocks])
+            merged[name] = np.where(inside, merged[name], max(block.max() for block in blocks))
+    return single.Task1Data(**merged)
+
+def check_decomposition(groups, size, seed, options):
+    # Solve a supply chain of `groups` independent parts as one model and component by component,
+    # the two overall costs must agree up to the solver tolerance
+    with tempfile.TemporaryDirectory() as workdir:
+        single.CACHE_DIR = os.path.join(workdir, 'cache')
+        data = make_decomposable_supply_chain(workdir, groups, size, seed)
+
+    solutions = [single.solve_task1(data, options['builder'], options['sparse'], backend= options['backend']),
+                 single.solve_task1_components(data, options['builder'], options['sparse'], backend= options['backend'])]
+    monolithic, decomposed = [solution[0] if solution is not None else None for solution in solutions]
+    return {'groups': groups, 'size': size, 'seed': seed, 'components': len(single.task1_components(data)),
+            'monolithic_cost': monolithic, 'decomposed_cost': decomposed,
+            'match': None not in (monolithic, decomposed) and bool(np.isclose(monolithic, decomposed, rtol= 1e-7))}
+
+def make_distances(path, towns, seed= 0):
+    # Road distances between random towns on a 500 x 500 map, returns the town names
+    rng = np.random.default_rng(seed)
+    labels = [f'Town {i:04d}' for i in range(towns)]
+    points = rng.random((towns, 2)) * 500
+    distance = np.rint(np.hypot(*(points[:, None, :] - points[None, :, :]).transpose(2, 0, 1))).astype(int)
+    distance = np.maximum(distance, 1) * (1 - np.eye(towns, dtype= int))
+    write_workbook(path, {'Distances': (None, labels, labels, distance)})
+    return labels
+
+def make_price_history(path, assets, months, seed= 0):
+    # Monthly prices of `assets` random walks, half quoted in USD and half in EUR, plus the EURUSD rate
+    rng = np.random.default_rng(seed)
+    dates = [datetime.datetime(2000, 1, 1) + datetime.timedelta(days= 31 * i) for i in range(months)]
+    dates = [datetime.datetime(date.year, date.month, 1) for date in dates]
+    prices = 100 * np.cumprod(1 + rng.normal(0.005, 0.04, (months, assets)), axis= 0)
+    eurusd = 1.1 * np.cumprod(1 + rng.normal(0, 0.01, (months, 1)), axis= 0)
+    usd_assets = (assets + 1) // 2
+
+    write_workbook(path, {
+        'USD': ('Date', dates, [f'USD Asset {i:04d}' for i in range(usd_assets)], prices[:, :usd_assets]),
+        'EUR': ('Date', dates, [f'EUR Asset {i:04d}' for i in range(assets - usd_assets)], prices[:, usd_assets:]),
+        'Currency': ('Date', dates, ['EURUSD'], eurusd),
+    })
+
+def run_task(task, xlsx_path, towns, options, profile):
+    # one run of the task on a generated instance, followed by a load that is served from the npz cache
+    if task == 'task1':
+        single.task1(options['builder'], options['sparse'], xlsx_path, profile, backend= options['backend'],
+                     decompose= options['decompose'])
+    elif task == 'task2':
+        single.task2(towns, options['subtour'], xlsx_path, profile, engine= options['engine'],
+                     time_limit= options['time_limit'], warm_start= options['warm_start'], backend= options['backend'])
+    elif task == 'task3':
+        single.task3('USD', xlsx_path, profile, backend= options['backend'])
+
+    single._workbook_tables.clear()
+    with profile.phase('load_cached'):
+        single.load_workbook_tables(xlsx_path)
+
+def run_case(task, size, seed, options):
+    # Generate one instance in a scratch directory and time the task on it. Runs in its own process,
+    # so the peak memory is that of this case alone. The times come from a run without tracemalloc, which
+    # slows the task down, and the peak memory of each phase from a second run on an empty cache with it.
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        xlsx_path = os.path.join(workdir, f'{task}.xlsx')
+        towns = None
+        if task == 'task1':
+            make_supply_chain(xlsx_path, seed= seed, **size)
+        elif task == 'task2':
+            towns = make_distances(xlsx_path, size['towns'], seed)
+        elif task == 'task3':
+            make_price_history(xlsx_path, size['assets'], size['months'], seed)
+
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            single.CACHE_DIR = os.path.join(workdir, 'cache')
+            profile = single.Profile()
+            run_task(task, xlsx_path, towns, options, profile)
+            result = profile.as_dict()
+
+            single.CACHE_DIR = os.path.join(workdir, 'memory_cache')
+            single._workbook_tables.clear()
+            memory_profile = single.Profile(trace_memory= True)
+            run_task(task, xlsx_path, towns, options, memory_profile)
+        os.chdir(cwd)
+
+    for name, record in result['phases'].items():
+        record['peak_memory'] = memory_profile.phases.get(name, {}).get('peak_memory')
+    return dict(result, task= task, size= size, seed= seed, options= options)
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output= True, text= True,
+                              cwd= os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description= 'Time task1, task2 and task3 on seeded synthetic instances.')
+    parser.add_argument('--tasks', nargs= '+', default= list(SIZES), choices= list(SIZES))
+    parser.add_argument('--seed', type= int, default= 0)
+    parser.add_argument('--max-size', type= int, default= len(SIZES['task1']), help= 'number of sizes to run per task')
+    parser.add_argument('--builder', default= 'matrix', choices= ['loop', 'matrix'])
+    parser.add_argument('--sparse', action= 'store_true')
+    parser.add_argument('--decompose', action= 'store_true', help= 'solve the independent components of task1 separately')
+    parser.add_argument('--subtour', default= 'lazy', choices= ['lazy', 'mtz', 'full'])
+    parser.add_argument('--engine', default= 'mip', choices= ['mip', 'heuristic', 'routing'])
+    parser.add_argument('--time-limit', type= float, default= None, help= 'seconds for the task2 routing engine')
+    parser.add_argument('--warm-start', action= 'store_true', help= 'warm start the task2 MIP from the heuristic tour')
+    parser.add_argument('--backend', default= 'glop', choices= list(single.SOLVER_BACKENDS), help= 'LP backend of task1 and task3')
+    parser.add_argument('--mip-backend', default= 'cbc', choices= ['cbc', 'scip', 'cp-sat'], help= 'MIP backend of task2')
+    parser.add_argument('--threads', type= int, default= None)
+    parser.add_argument('--output', default= 'benchmark_results.json')
+    parser.add_argument('--check-decomposition', type= int, default= None, metavar= 'GROUPS',
+                        help= 'only compare task1 solved as one model and by components on GROUPS independent '
+                              'supply chains of the second task1 size, exits with 1 if the costs differ')
+    args = parser.parse_args()
+
+    backend = single.SolverConfig(args.backend, args.threads)
+    options = {'task1': {'builder': args.builder, 'sparse': args.sparse, 'decompose': args.decompose, 'backend': backend},
+               'task2': {'subtour': args.subtour, 'engine': args.engine, 'time_limit': args.time_limit, 'warm_start': args.warm_start,
+                         'backend': single.SolverConfig(args.mip_backend, args.threads)},
+               'task3': {'backend': backend}}
+    if args.check_decomposition is not None:
+        result = check_decomposition(args.check_decomposition, SIZES['task1'][1], args.seed, options['task1'])
+        print(f"task1 {result['groups']} groups, {result['components']} components: monolithic cost "
+              f"{result['monolithic_cost']}, decomposed cost {result['decomposed_cost']}, {'match' if result['match'] else 'MISMATCH'}")
+        raise SystemExit(0 if result['match'] else 1)
+
+    results = []
+    # a fresh process per case keeps the peak memory of one case from hiding the next
+    context = multiprocessing.get_context('spawn')
+    for task in args.tasks:
+        for size in SIZES[task][:args.max_size]:
+            with ProcessPoolExecutor(max_workers= 1, mp_context= context) as executor:
+                result = executor.submit(run_case, task, size, args.seed, options[task]).result()
+            results.append(result)
+
+            phases = ', '.join(f"{name} {record['wall_time']:.3f}s {(record['peak_memory'] or 0) / 2 ** 20:.1f} MiB"
+                               for name, record in result['phases'].items())
+            print(f"{task} {size}: {phases}, peak memory {result['peak_memory'] / 2 ** 20:.1f} MiB")
+
+    with open(args.output, 'w') as f:
+        json.dump({'commit': git_commit(), 'python': platform.python_version(), 'platform': platform.platform(),
+                   'results': results}, f, indent= 2)
+
+if __name__ == '__main__':
+    main()
@@ -1,77 +1,482 @@
 from openpyxl import load_workbook
 from ortools.linear_solver import pywraplp
-from itertools import combinations
+from ortools.linear_solver.python import model_builder_helper as mbh
+from ortools.constraint_solver import pywrapcp, routing_enums_pb2
+from itertools import combinations, islice
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future
+from contextlib import contextmanager, nullcontext
+from collections import namedtuple, OrderedDict
+from scipy import sparse as scipy_sparse
+from scipy.sparse.csgraph import connected_components
+import numpy as np
+import hashlib
+import json
 import csv
+import os
+import re
+import resource
+import socketserver
+import threading
+import time
+import tracemalloc
 
-def load_sheet(sheet, data_dict, NoneValue= None):
-    data = []
-    for row in sheet.iter_rows(values_only=True):
-        data.append([str(cell) for cell in row])
-    
-    row_headers = [row[0] for row in data[1:] if row[0] != 'None']
-    col_headers = [x for x in data[0][1:] if x != 'None']
+CACHE_DIR = '.cache'
+# size limit of the solve results kept in CACHE_DIR/results
+RESULT_CACHE_BYTES = 64 * 2 ** 20
 
-    for i in range(len(row_headers)):
-        for j in range(len(col_headers)):
-            if data[i + 1][j + 1] != 'None':
-                data_dict[row_headers[i], col_headers[j]] = int(data[i + 1][j + 1])
-            else:
-                data_dict[row_headers[i], col_headers[j]] = NoneValue
+# parsed workbooks of this process, keyed on the workbook key
+_workbook_tables = {}
 
-def load_sheet_3(sheet, data_dict, NoneValue= None):
-    data = []
-    for row in sheet.iter_rows(values_only=True):
-        data.append([str(cell) for cell in row])
-    
-    row_headers = [row[0] for row in data[1:] if row[0] != 'None']
-    col_headers = [x for x in data[0][1:] if x != 'None']
+# a sheet as a dense array with its row and column labels, missing cells are flagged in `missing`
+Table = namedtuple('Table', ['values', 'rows', 'cols', 'missing'])
+
+# the tracemalloc peaks of the phases that are running, see Profile.phase, and whether a phase started
+# tracemalloc, which then stops when the last running phase ends
+_traced_phases = []
+_tracing_started = False
+
+def fold_traced_peak():
+    # hand the traced peak since the last reset to every running phase and reset it, so that nested phases
+    # can each measure their own peak
+    peak = tracemalloc.get_traced_memory()[1]
+    for running in _traced_phases:
+        running['peak'] = max(running['peak'], peak)
+    tracemalloc.reset_peak()
+
+class Profile:
+    # Instrumentation of a task run: the wall time of named phases, the memory each phase used and the
+    # statistics of every solver run. peak_memory of a phase is the highest amount of memory allocated through
+    # Python (NumPy arrays included) above the amount at the start of the phase, measured with tracemalloc;
+    # memory_growth is the change of the resident memory of the process over the phase, which also covers
+    # the solvers' own memory. tracemalloc slows down Python code that allocates a lot, up to twice as slow
+    # for the loop builder, so peak_memory is only measured with trace_memory= True and is None otherwise.
+    # A phase that is entered several times adds up its wall time and memory growth and keeps its highest peak.
+
+    def __init__(self, trace_memory= False):
+        self.phases = {}
+        self.solvers = []
+        self.trace_memory = trace_memory
+
+    @contextmanager
+    def phase(self, name):
+        global _tracing_started
+        traced = None
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                _tracing_started = True
+            fold_traced_peak()
+            traced = {'start': tracemalloc.get_traced_memory()[0], 'peak': 0}
+            _traced_phases.append(traced)
+        resident = current_memory()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            wall_time = time.perf_counter() - start
+            record = self.phases.setdefault(name, {'wall_time': 0.0, 'peak_memory': None, 'memory_growth': 0})
+            record['wall_time'] += wall_time
+            record['memory_growth'] += current_memory() - resident
+            if traced is not None:
+                fold_traced_peak()
+                _traced_phases.remove(traced)
+                record['peak_memory'] = max(record['peak_memory'] or 0, traced['peak'] - traced['start'])
+                if not _traced_phases and _tracing_started:
+                    tracemalloc.stop()
+                    _tracing_started = False
+
+    def add_solver(self, name, stats):
+        self.solvers.append(dict(stats, name= name))
+
+    def as_dict(self):
+        return {'phases': self.phases, 'solvers': self.solvers, 'peak_memory': peak_memory()}
+
+def peak_memory():
+    # high-water mark of the resident memory of this process in bytes, ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def current_memory():
+    # resident memory of this process in bytes, 0 where /proc is not available
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return 0
+
+def phase(profile, name):
+    return profile.phase(name) if profile is not None else nullcontext()
+
+STATUS_NAMES = {pywraplp.Solver.OPTIMAL: 'optimal', pywraplp.Solver.FEASIBLE: 'feasible',
+                pywraplp.Solver.INFEASIBLE: 'infeasible', pywraplp.Solver.UNBOUNDED: 'unbounded',
+                pywraplp.Solver.ABNORMAL: 'abnormal', pywraplp.Solver.MODEL_INVALID: 'model_invalid',
+                pywraplp.Solver.NOT_SOLVED: 'not_solved'}
+
+# pywraplp and model builder names of the solver backends, CBC is not available through the model builder
+SOLVER_BACKENDS = {'glop': 'GLOP', 'pdlp': 'PDLP', 'cbc': 'CBC', 'scip': 'SCIP', 'cp-sat': 'CP_SAT'}
+MODEL_BUILDER_BACKENDS = {'glop': 'glop', 'pdlp': 'pdlp', 'scip': 'scip', 'cp-sat': 'sat'}
+# the backends that keep integer variables integer, GLOP and PDLP solve the LP relaxation
+MIP_BACKENDS = ['cbc', 'scip', 'cp-sat']
+
+# Solver backend and its limits: threads, time_limit in seconds and the relative_gap at which a MIP solve stops.
+# None leaves the backend's default, GLOP and CBC are single threaded and ignore threads.
+SolverConfig = namedtuple('SolverConfig', ['backend', 'threads', 'time_limit', 'relative_gap'], defaults= [None, None, None])
 
+def solver_config(backend, default):
+    # a SolverConfig from a SolverConfig, a backend name or None for the default backend
+    if backend is None:
+        return SolverConfig(default)
+    if isinstance(backend, str):
+        return SolverConfig(backend)
+    return backend
+
+def create_solver(config):
+    # pywraplp solver of the backend with the thread count and time limit of the config
+    if config.backend not in SOLVER_BACKENDS:
+        raise ValueError(f"Unknown solver backend: {config.backend}")
+    solver = pywraplp.Solver.CreateSolver(SOLVER_BACKENDS[config.backend])
+    if solver is None:
+        raise ValueError(f"Solver backend {config.backend} is not available in this OR-Tools build")
+    # the CBC of OR-Tools is built without threads and only complains about the option, use SCIP or CP-SAT for parallel MIP solves
+    if config.threads is not None and config.backend != 'cbc':
+        solver.SetNumThreads(config.threads)
+    if config.time_limit is not None:
+        solver.SetTimeLimit(int(config.time_limit * 1000))
+    return solver
+
+def run_solver(solver, config):
+    # Solve with the relative gap of the config, returns the status and the wall time of the solve in seconds
+    parameters = pywraplp.MPSolverParameters()
+    if config.relative_gap is not None and solver.IsMip():
+        parameters.SetDoubleParam(pywraplp.MPSolverParameters.RELATIVE_MIP_GAP, config.relative_gap)
+    start = time.perf_counter()
+    status = solver.Solve(parameters)
+    return status, time.perf_counter() - start
+
+def create_model_solver(config):
+    # model builder solver of the backend, the limits are passed as backend specific parameters
+    if config.backend not in MODEL_BUILDER_BACKENDS:
+        raise ValueError(f"Solver backend {config.backend} is not available for the model builder")
+    solver = mbh.ModelSolverHelper(MODEL_BUILDER_BACKENDS[config.backend])
+    if not solver.solver_is_supported():
+        raise ValueError(f"Solver backend {config.backend} is not available in this OR-Tools build")
+    parameters = []
+    if config.backend == 'pdlp' and config.threads is not None:
+        parameters.append(f"num_threads:{config.threads}")
+    elif config.backend == 'cp-sat':
+        if config.threads is not None:
+            parameters.append(f"num_workers:{config.threads}")
+        if config.relative_gap is not None:
+            parameters.append(f"relative_gap_limit:{config.relative_gap}")
+    elif config.backend == 'scip':
+        if config.threads is not None:
+            parameters.append(f"parallel/maxnthreads = {config.threads}")
+        if config.relative_gap is not None:
+            parameters.append(f"limits/gap = {config.relative_gap}")
+    if parameters:
+        solver.set_solver_specific_parameters((',' if config.backend != 'scip' else '\n').join(parameters))
+    if config.time_limit is not None:
+        solver.set_time_limit_in_seconds(config.time_limit)
+    return solver
+
+def run_model_solver(solver, model):
+    # Solve a model builder model, returns the wall time of the solve in seconds. The solver's own wall_time
+    # stays 0 for GLOP and PDLP.
+    start = time.perf_counter()
+    solver.solve(model)
+    return time.perf_counter() - start
+
+# the columns a result table gets for the solve behind each row, filled by stats_columns
+STATS_HEADER = ['status', 'backend', 'solve_time']
+
+def stats_columns(stats):
+    return [stats['status'], stats['solver'], stats['solve_time']]
+
+def config_stats(config):
+    return {'solver': config.backend, 'threads': config.threads, 'time_limit': config.time_limit, 'relative_gap': config.relative_gap}
+
+def solver_stats(solver, status, config= None, solve_time= None):
+    # statistics of the last solve of a pywraplp solver, wall_time is the time since the solver was created
+    # and solve_time the time of the solve itself
+    stats = {'backend': solver.SolverVersion(), 'status': STATUS_NAMES.get(status, str(status)),
+             'num_variables': solver.NumVariables(), 'num_constraints': solver.NumConstraints(),
+             'iterations': solver.iterations(), 'wall_time': solver.wall_time() / 1000.0}
+    if solver.IsMip():
+        stats['nodes'] = solver.nodes()
+    if solve_time is not None:
+        stats['solve_time'] = solve_time
+    if config is not None:
+        stats.update(config_stats(config))
+    return stats
+
+def model_solver_stats(model, solver, config, solve_time):
+    # statistics of a model builder solve, solve_time as returned by run_model_solver
+    return dict({'backend': MODEL_BUILDER_BACKENDS[config.backend], 'status': solver.status().name.lower(),
+                 'num_variables': model.num_variables(), 'num_constraints': model.num_constraints(),
+                 'wall_time': solver.wall_time(), 'solve_time': solve_time}, **config_stats(config))
+
+def result_json(result, **kwargs):
+    # JSON text of a task result, NumPy values are converted to plain numbers and lists
+    def convert(value):
+        if isinstance(value, np.generic):
+            return value.item()
+        if isinstance(value, np.ndarray):
+            return value.tolist()
+        raise TypeError(f"{type(value).__name__} is not JSON serializable")
+    return json.dumps(result, default= convert, **kwargs)
+
+def workbook_key(path):
+    # the key changes whenever the workbook is moved, touched or edited
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    key = f"{os.path.abspath(path)}|{os.stat(path).st_mtime_ns}|{digest.hexdigest()}"
+    return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+def parse_sheet(sheet):
+    data = [row for row in sheet.iter_rows(values_only=True)]
+
+    row_headers = [str(row[0]) for row in data[1:] if row[0] is not None]
+    col_headers = [str(x) for x in data[0][1:] if x is not None]
+
+    values = np.zeros((len(row_headers), len(col_headers)), dtype= np.float64)
+    missing = np.ones((len(row_headers), len(col_headers)), dtype= bool)
     for i in range(len(row_headers)):
-        for j in range(len(col_headers)):
-            if data[i + 1][j + 1] != 'None':
-                data_dict[row_headers[i], col_headers[j]] = float(data[i + 1][j + 1])
-            else:
-                data_dict[row_headers[i], col_headers[j]] = NoneValue
+        row = data[i + 1]
+        for j in range(min(len(col_headers), len(row) - 1)):
+            if row[j + 1] is not None:
+                values[i, j] = float(row[j + 1])
+                missing[i, j] = False
 
-def task1():
-    solver = pywraplp.Solver.CreateSolver("GLOP_LINEAR_PROGRAMMING")
+    return Table(values, row_headers, col_headers, missing)
 
-    # 1. Load the xlsx file
-    xlsx_file = load_workbook('Assignment_DA_2_Task_1_data.xlsx', read_only= True)
-
-    # define the sheets
-    supplier_stock_sheet = xlsx_file['Supplier stock']
-    raw_mat_costs_sheet = xlsx_file['Raw material costs']
-    raw_mat_ship_sheet = xlsx_file['Raw material shipping']
-    prod_req_sheet = xlsx_file['Product requirements']
-    prod_cap_sheet = xlsx_file['Production capacity']
-    prod_cost_sheet = xlsx_file['Production cost']
-    customer_demand_sheet = xlsx_file['Customer demand']
-    ship_cost_sheet = xlsx_file['Shipping costs']
-
-    # load sheets
-    supplier_stock = {}
-    load_sheet(supplier_stock_sheet, supplier_stock, NoneValue= 0)
-    raw_mat_costs = {}
-    load_sheet(raw_mat_costs_sheet, raw_mat_costs, NoneValue= 0)
-    raw_mat_ship = {}
-    load_sheet(raw_mat_ship_sheet, raw_mat_ship, NoneValue= 0)
-    prod_req = {}
-    load_sheet(prod_req_sheet, prod_req, NoneValue= 0)
-    prod_cap = {}
-    load_sheet(prod_cap_sheet, prod_cap, NoneValue= 0)
-    prod_cost = {}
-    load_sheet(prod_cost_sheet, prod_cost, NoneValue= 0)
-    customer_demand = {}
-    load_sheet(customer_demand_sheet, customer_demand, NoneValue= 0)
-    ship_cost = {}
-    load_sheet(ship_cost_sheet, ship_cost, NoneValue= 0)
-
-    suppliers = sorted(list(set([key[0] for key in supplier_stock.keys()])))
-    materials = sorted(list(set([key[1] for key in supplier_stock.keys()])))
-    factories = sorted(list(set([key[1] for key in raw_mat_ship.keys()])))
-    products = sorted(list(set([key[0] for key in prod_req.keys()])))
-    customers = sorted(list(set([key[1] for key in customer_demand.keys()])))
+def load_workbook_tables(path, cache_dir= None):
+    # Parse every sheet of the workbook once, later calls are served from memory or from the npz cache on disk.
+    # cache_dir defaults to CACHE_DIR, an empty string turns the disk cache off
+    if cache_dir is None:
+        cache_dir = CACHE_DIR
+    key = workbook_key(path)
+    if key in _workbook_tables:
+        return _workbook_tables[key]
+
+    # the npz files of a workbook share a prefix for its path, so that older versions can be removed
+    path_prefix = hashlib.sha256(os.path.abspath(path).encode()).hexdigest()[:16] + '-'
+    cache_file = os.path.join(cache_dir, f"{path_prefix}{key}.npz") if cache_dir else None
+    tables = {}
+    if cache_file and os.path.exists(cache_file):
+        try:
+            with np.load(cache_file, allow_pickle= False) as cached:
+                for i, name in enumerate(cached['sheets'].tolist()):
+                    tables[name] = Table(cached[f'values_{i}'], cached[f'rows_{i}'].tolist(),
+                                         cached[f'cols_{i}'].tolist(), cached[f'missing_{i}'])
+        except OSError:
+            # removed by a process that cached a newer version of the workbook in the meantime
+            tables = {}
+    if not tables:
+        xlsx_file = load_workbook(path, read_only= True)
+        for sheet in xlsx_file.worksheets:
+            tables[sheet.title] = parse_sheet(sheet)
+        xlsx_file.close()
+
+        if cache_file:
+            arrays = {'sheets': np.array(list(tables.keys()), dtype= str)}
+            for i, table in enumerate(tables.values()):
+                arrays[f'values_{i}'] = table.values
+                arrays[f'rows_{i}'] = np.array(table.rows, dtype= str)
+                arrays[f'cols_{i}'] = np.array(table.cols, dtype= str)
+                arrays[f'missing_{i}'] = table.missing
+            os.makedirs(cache_dir, exist_ok= True)
+            # write to a temporary file first so that a concurrent reader never sees a half written cache
+            tmp_file = f"{cache_file}.{os.getpid()}.tmp.npz"
+            np.savez(tmp_file, **arrays)
+            os.replace(tmp_file, cache_file)
+            # the npz files of earlier versions of this workbook are never read again
+            for entry in os.scandir(cache_dir):
+                if entry.name.startswith(path_prefix) and entry.name.endswith('.npz') and '.tmp.' not in entry.name \
+                        and entry.path != cache_file:
+                    try:
+                        os.remove(entry.path)
+                    except OSError:
+                        pass
+
+    _workbook_tables[key] = tables
+    return tables
+
+def load_table(path, sheet_name, dtype= np.float64, NoneValue= 0):
+    # Return the sheet as a Table of the given dtype with missing cells set to NoneValue
+    table = load_workbook_tables(path)[sheet_name]
+    values = np.where(table.missing, NoneValue, table.values).astype(dtype)
+    return Table(values, table.rows, table.cols, table.missing)
+
+def data_key(*parts):
+    # Content hash of parsed input data and model parameters. Arrays are hashed by dtype, shape and bytes,
+    # everything else by its JSON text, so the key does not depend on file names or modification times.
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            digest.update(f"{part.dtype}{part.shape}".encode())
+            digest.update(np.ascontiguousarray(part).tobytes())
+        else:
+            digest.update(result_json(part, sort_keys= True).encode())
+        digest.update(b'|')
+    return digest.hexdigest()[:32]
+
+def load_result(key, cache_dir= None):
+    # Solve result stored under key by store_result, None if there is none.
+    # cache_dir defaults to CACHE_DIR, an empty string turns the result cache off
+    if cache_dir is None:
+        cache_dir = CACHE_DIR
+    if not cache_dir:
+        return None
+    cache_file = os.path.join(cache_dir, 'results', f"{key}.json")
+    try:
+        with open(cache_file) as f:
+            value = json.load(f)
+    except (OSError, ValueError):
+        return None
+    # a hit counts as a use for the eviction order, unless another process has just evicted the file
+    try:
+        os.utime(cache_file)
+    except OSError:
+        pass
+    return value
+
+def definitive(status, time_limit= None):
+    # whether a solve result can be cached: an optimum, or infeasibility that was not cut short by a time limit
+    return status == 'optimal' or (status == 'infeasible' and time_limit is None)
+
+def store_result(key, value, cache_dir= None, max_bytes= None):
+    # Store a JSON serialisable solve result under key, then evict the least recently used results
+    # until the result cache is at most max_bytes (default RESULT_CACHE_BYTES) large
+    if cache_dir is None:
+        cache_dir = CACHE_DIR
+    if max_bytes is None:
+        max_bytes = RESULT_CACHE_BYTES
+    if not cache_dir:
+        return
+    results_dir = os.path.join(cache_dir, 'results')
+    os.makedirs(results_dir, exist_ok= True)
+    cache_file = os.path.join(results_dir, f"{key}.json")
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+    with open(tmp_file, 'w') as f:
+        f.write(result_json(value))
+    os.replace(tmp_file, cache_file)
+
+    entries = []
+    for entry in os.scandir(results_dir):
+        if entry.name.endswith('.json'):
+            stat = entry.stat()
+            entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path != cache_file:
+            os.remove(path)
+            total -= size
+
+def table_dict3(values, labels1, labels2, labels3):
+    # tuple keyed view of a three dimensional array, {(label1, label2, label3): value}
+    data_dict = {}
+    for label1, plane in zip(labels1, values.tolist()):
+        for label2, row in zip(labels2, plane):
+            for label3, value in zip(labels3, row):
+                data_dict[label1, label2, label3] = value
+    return data_dict
+
+def table_dict(table):
+    # tuple keyed view of a Table, {(row, col): value}
+    data_dict = {}
+    for row, values in zip(table.rows, table.values.tolist()):
+        for col, value in zip(table.cols, values):
+            data_dict[row, col] = value
+    return data_dict
+
+# the task1 supply chain as arrays, one row/column per sorted label
+Task1Data = namedtuple('Task1Data', ['suppliers', 'materials', 'factories', 'products', 'customers',
+                                     'supplier_stock', 'raw_mat_costs', 'raw_mat_ship', 'prod_req',
+                                     'prod_cap', 'prod_cost', 'customer_demand', 'ship_cost'])
+
+def write_csv(path, header, rows):
+    # write to a temporary file and rename it over the old one, so the file is either the old or the new one and never half written
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", newline= "") as f:
+        csvwriter = csv.writer(f)
+        csvwriter.writerow(header)
+        csvwriter.writerows(rows)
+    os.replace(tmp_path, path)
+
+def table_array(table, rows, cols):
+    # reorder the values of a table to the given row and column labels
+    row_index = {label: i for i, label in enumerate(table.rows)}
+    col_index = {label: j for j, label in enumerate(table.cols)}
+    return table.values[np.ix_([row_index[row] for row in rows], [col_index[col] for col in cols])]
+
+def load_task1_data(xlsx_path= 'Assignment_DA_2_Task_1_data.xlsx'):
+    supplier_stock = load_table(xlsx_path, 'Supplier stock', dtype= int)
+    raw_mat_costs = load_table(xlsx_path, 'Raw material costs', dtype= int)
+    raw_mat_ship = load_table(xlsx_path, 'Raw material shipping', dtype= int)
+    prod_req = load_table(xlsx_path, 'Product requirements', dtype= int)
+    prod_cap = load_table(xlsx_path, 'Production capacity', dtype= int)
+    prod_cost = load_table(xlsx_path, 'Production cost', dtype= int)
+    customer_demand = load_table(xlsx_path, 'Customer demand', dtype= int)
+    ship_cost = load_table(xlsx_path, 'Shipping costs', dtype= int)
+
+    suppliers = sorted(supplier_stock.rows)
+    materials = sorted(supplier_stock.cols)
+    factories = sorted(raw_mat_ship.cols)
+    products = sorted(prod_req.rows)
+    customers = sorted(customer_demand.cols)
+
+    return Task1Data(suppliers, materials, factories, products, customers,
+                     table_array(supplier_stock, suppliers, materials),
+                     table_array(raw_mat_costs, suppliers, materials),
+                     table_array(raw_mat_ship, suppliers, factories),
+                     table_array(prod_req, products, materials),
+                     table_array(prod_cap, products, factories),
+                     table_array(prod_cost, products, factories),
+                     table_array(customer_demand, products, customers),
+                     table_array(ship_cost, factories, customers))
+
+def task1_dicts(data):
+    # tuple keyed views of the task1 sheets, in the order of the Task1Data fields
+    return (table_dict(Table(data.supplier_stock, data.suppliers, data.materials, None)),
+            table_dict(Table(data.raw_mat_costs, data.suppliers, data.materials, None)),
+            table_dict(Table(data.raw_mat_ship, data.suppliers, data.factories, None)),
+            table_dict(Table(data.prod_req, data.products, data.materials, None)),
+            table_dict(Table(data.prod_cap, data.products, data.factories, None)),
+            table_dict(Table(data.prod_cost, data.products, data.factories, None)),
+            table_dict(Table(data.customer_demand, data.products, data.customers, None)),
+            table_dict(Table(data.ship_cost, data.factories, data.customers, None)))
+
+def task1_masks(data, sparse= True):
+    # The (S, M, F), (P, F) and (C, P, F) combinations that get a variable.
+    # With sparse=True only combinations that can be nonzero in an optimal solution are kept:
+    # a factory only produces products it has capacity for, only delivers products the customer demands
+    # and only orders materials the supplier has in stock and one of its products needs.
+    # This relies on all costs being non-negative, so that ordering or delivering more than needed never pays off.
+    S, M, F, P, C = len(data.suppliers), len(data.materials), len(data.factories), len(data.products), len(data.customers)
+    if not sparse:
+        return np.ones((S, M, F), dtype= bool), np.ones((P, F), dtype= bool), np.ones((C, P, F), dtype= bool)
+
+    prod_mask = data.prod_cap > 0
+    material_used = task1_material_used(data, prod_mask)
+    order_mask = (data.supplier_stock > 0)[:, :, None] & material_used[None, :, :]
+    delivery_mask = (data.customer_demand.T > 0)[:, :, None] & prod_mask[None, :, :]
+    return order_mask, prod_mask, delivery_mask
+
+def task1_material_used(data, prod_mask):
+    # the (M, F) combinations where the factory makes a product that needs the material
+    return ((data.prod_req[:, :, None] > 0) & prod_mask[:, None, :]).any(axis= 0)
+
+def build_task1_loop(solver, data, sparse= False):
+    # Build the task1 model one variable and one constraint at a time through pywraplp
+    suppliers, materials, factories, products, customers = data.suppliers, data.materials, data.factories, data.products, data.customers
+    supplier_stock, raw_mat_costs, raw_mat_ship, prod_req, prod_cap, prod_cost, customer_demand, ship_cost = task1_dicts(data)
+    order_mask, prod_mask, delivery_mask = task1_masks(data, sparse)
+    order_feasible = table_dict3(order_mask, suppliers, materials, factories)
+    prod_feasible = table_dict(Table(prod_mask, products, factories, None))
+    delivery_feasible = table_dict3(delivery_mask, customers, products, factories)
 
     # 2. Define the variables
     # supplier order variables
@@ -79,362 +484,1673 @@ def task1():
     for supplier in suppliers:
         for material in materials:
             for factory in factories:
-                supplier_order_vars[supplier, material, factory] = solver.IntVar(0, solver.infinity(), f'supplier_order[{supplier}, {material}, {factory}]')
+                if order_feasible[supplier, material, factory]:
+                    supplier_order_vars[supplier, material, factory] = solver.IntVar(0, solver.infinity(), f'supplier_order[{supplier}, {material}, {factory}]')
     
     # production volume variables
     production_vol_vars = {}
     for product in products:
         for factory in factories:
-            production_vol_vars[product, factory] = solver.IntVar(0, solver.infinity(), f'production_volume[{product}, {factory}]')
+            if prod_feasible[product, factory]:
+                production_vol_vars[product, factory] = solver.IntVar(0, solver.infinity(), f'production_volume[{product}, {factory}]')
     
     # customer delivery variables
     customer_delivery_vars = {}
     for customer in customers:
         for product in products:
             for factory in factories:
-                customer_delivery_vars[customer, product, factory] =\
-                    solver.IntVar(0, solver.infinity(), f'customer_delivery[{customer}, {product}, {factory}]')
+                if delivery_feasible[customer, product, factory]:
+                    customer_delivery_vars[customer, product, factory] =\
+                        solver.IntVar(0, solver.infinity(), f'customer_delivery[{customer}, {product}, {factory}]')
+
+    # Rows without any variable are left out, except for a demand that can not be delivered at all
+    # which is kept as an empty constraint so that the model stays infeasible.
+
+    # handles of the constraints whose bounds or coefficients come from a sheet, keyed like the sheet
+    constraints = {'customer_demand': {}, 'supplier_stock': {}, 'prod_req': {}, 'prod_cap': {}}
 
     # 3. Define and implement the constraints that ensure factories produce more than they ship to the customers
     for product in products:
         for factory in factories:
-            solver.Add(production_vol_vars[product, factory] - sum([customer_delivery_vars[customer, product, factory] for customer in customers]) >= 0)
+            if (product, factory) in production_vol_vars:
+                solver.Add(production_vol_vars[product, factory] - solver.Sum([customer_delivery_vars[customer, product, factory] for customer in customers\
+                                                                               if (customer, product, factory) in customer_delivery_vars]) >= 0)
     
     # 4. Define and implement the constraints that ensure that customer demand is met
     for customer in customers:
         for product in products:
-            solver.Add(sum([customer_delivery_vars[customer, product, factory] for factory in factories]) >= customer_demand[product, customer])
+            if customer_demand[product, customer] > 0 or not sparse:
+                constraints['customer_demand'][product, customer] =\
+                    solver.Add(solver.Sum([customer_delivery_vars[customer, product, factory] for factory in factories\
+                                           if (customer, product, factory) in customer_delivery_vars]) >= customer_demand[product, customer])
 
     # 5. Define and implement the constraints that ensure that suppliers have all ordered items in stock
     for supplier in suppliers:
         for material in materials:
-            solver.Add(sum([supplier_order_vars[supplier, material, factory] for factory in factories]) <= supplier_stock[supplier, material])
+            order_terms = [supplier_order_vars[supplier, material, factory] for factory in factories if (supplier, material, factory) in supplier_order_vars]
+            if order_terms:
+                constraints['supplier_stock'][supplier, material] = solver.Add(solver.Sum(order_terms) <= supplier_stock[supplier, material])
 
     for material in materials:
         for factory in factories:
-            solver.Add(sum([supplier_order_vars[supplier, material, factory] for supplier in suppliers]) -\
-                       sum([production_vol_vars[product, factory] * prod_req[product, material] for product in products]) >= 0)
+            prod_terms = [production_vol_vars[product, factory] * prod_req[product, material] for product in products\
+                          if (product, factory) in production_vol_vars and (prod_req[product, material] != 0 or not sparse)]
+            if prod_terms:
+                constraints['prod_req'][material, factory] =\
+                    solver.Add(solver.Sum([supplier_order_vars[supplier, material, factory] for supplier in suppliers\
+                                           if (supplier, material, factory) in supplier_order_vars]) - solver.Sum(prod_terms) >= 0)
     
     # 6. Define and implement the constraints that ensure that the manufacturing capacities are not exceeded
     for product in products:
         for factory in factories:
-            solver.Add(production_vol_vars[product, factory] <= prod_cap[product, factory])
+            if (product, factory) in production_vol_vars:
+                constraints['prod_cap'][product, factory] = solver.Add(production_vol_vars[product, factory] <= prod_cap[product, factory])
     
     # 7. Define and implement the objective function.
     supplier_cost = sum([supplier_order_vars[supplier, material, factory] * raw_mat_costs[supplier, material]\
-                         for supplier in suppliers for material in materials for factory in factories])
+                         for supplier, material, factory in supplier_order_vars])
     
     supplier_ship_cost = sum([supplier_order_vars[supplier, material, factory] * raw_mat_ship[supplier, factory]\
-                         for supplier in suppliers for material in materials for factory in factories])
+                         for supplier, material, factory in supplier_order_vars])
 
     production_cost = sum([production_vol_vars[product, factory] * prod_cost[product, factory]\
-                           for product in products for factory in factories])
+                           for product, factory in production_vol_vars])
     
     customer_ship_cost = sum([customer_delivery_vars[customer, product, factory] * ship_cost[factory, customer]\
-                              for customer in customers for product in products for factory in factories])
+                              for customer, product, factory in customer_delivery_vars])
     
     overall_cost = supplier_cost + supplier_ship_cost + production_cost + customer_ship_cost
 
     solver.Minimize(overall_cost)
 
-    # 8. Solve the linear program and determine the optimal overall cost 
-    status = solver.Solve()
+    return supplier_order_vars, production_vol_vars, customer_delivery_vars, constraints
 
-    if status == pywraplp.Solver.OPTIMAL:
-        print(f"Overall Cost: {solver.Objective().Value()}")
+def task1_var_index(data, sparse= False):
+    # Column of each supplier order, production volume and customer delivery variable in the
+    # matrix model, -1 for combinations that get no variable
+    order_mask, prod_mask, delivery_mask = task1_masks(data, sparse)
+    num_orders, num_prods = int(order_mask.sum()), int(prod_mask.sum())
+    order_index = np.full(order_mask.shape, -1)
+    order_index[order_mask] = np.arange(num_orders)
+    prod_index = np.full(prod_mask.shape, -1)
+    prod_index[prod_mask] = num_orders + np.arange(num_prods)
+    delivery_index = np.full(delivery_mask.shape, -1)
+    delivery_index[delivery_mask] = num_orders + num_prods + np.arange(int(delivery_mask.sum()))
+    return order_index, prod_index, delivery_index
 
-        print("\n")
+def build_task1_matrix(data, sparse= False, integer= False):
+    # Build the task1 model in bulk from a sparse constraint matrix and a cost vector.
+    # The variables are laid out as [supplier orders (S, M, F), production volumes (P, F), customer deliveries (C, P, F)]
+    # and the constraint rows follow the same numbered steps as build_task1_loop.
+    # integer makes every variable integer like the IntVars of build_task1_loop, for the MIP backends.
+    S, M, F, P, C = len(data.suppliers), len(data.materials), len(data.factories), len(data.products), len(data.customers)
+    order_index, prod_index, delivery_index = task1_var_index(data, sparse)
+    num_vars = int(max(order_index.max(initial= -1), prod_index.max(initial= -1), delivery_index.max(initial= -1))) + 1
+
+    rows, cols, coefs, lower, upper = [], [], [], [], []
+    num_rows = 0
+
+    def add_block(row_index, var_index, coef, lb, ub):
+        # row_index and var_index are broadcast against each other, lb and ub hold one bound per block row
+        nonlocal num_rows
+        row_index, var_index, coef = np.broadcast_arrays(row_index, var_index, coef)
+        nonzero = (coef != 0) & (var_index >= 0)
+        rows.append(num_rows + row_index[nonzero])
+        cols.append(var_index[nonzero])
+        coefs.append(coef[nonzero].astype(np.float64))
+        lower.append(np.asarray(lb, dtype= np.float64).ravel())
+        upper.append(np.asarray(ub, dtype= np.float64).ravel())
+        num_rows += lower[-1].size
+
+    pf_rows = np.arange(P * F).reshape(P, F)
+    cp_rows = np.arange(C * P).reshape(C, P)
+    sm_rows = np.arange(S * M).reshape(S, M)
+    mf_rows = np.arange(M * F).reshape(M, F)
+
+    # 3. production - deliveries >= 0 for each (product, factory)
+    add_block(np.concatenate([pf_rows.ravel(), np.broadcast_to(pf_rows, (C, P, F)).ravel()]),
+              np.concatenate([prod_index.ravel(), delivery_index.ravel()]),
+              np.concatenate([np.ones(P * F), -np.ones(C * P * F)]),
+              np.zeros(P * F), np.full(P * F, np.inf))
+
+    # 4. deliveries >= demand for each (customer, product)
+    add_block(cp_rows[:, :, None], delivery_index, 1.0, data.customer_demand.T, np.full(C * P, np.inf))
+
+    # 5. orders <= stock for each (supplier, material)
+    add_block(sm_rows[:, :, None], order_index, 1.0, np.full(S * M, -np.inf), data.supplier_stock)
+
+    # orders - production * requirement >= 0 for each (material, factory)
+    add_block(np.concatenate([np.broadcast_to(mf_rows, (S, M, F)).ravel(), np.broadcast_to(mf_rows, (P, M, F)).ravel()]),
+              np.concatenate([order_index.ravel(), np.broadcast_to(prod_index[:, None, :], (P, M, F)).ravel()]),
+              np.concatenate([np.ones(S * M * F), -np.broadcast_to(data.prod_req[:, :, None], (P, M, F)).ravel()]),
+              np.zeros(M * F), np.full(M * F, np.inf))
+
+    # 6. production <= capacity for each (product, factory)
+    add_block(pf_rows, prod_index, 1.0, np.full(P * F, -np.inf), data.prod_cap)
+
+    # 7. supplier cost + supplier shipping + production cost + customer shipping
+    objective = np.zeros(num_vars)
+    for var_index, cost in [(order_index, data.raw_mat_costs[:, :, None] + data.raw_mat_ship[:, None, :]),
+                            (prod_index, data.prod_cost),
+                            (delivery_index, np.broadcast_to(data.ship_cost.T[:, None, :], (C, P, F)))]:
+        objective[var_index[var_index >= 0]] = cost[var_index >= 0]
+
+    # drop the rows left without any variable unless they can not be satisfied
+    rows, cols, coefs = np.concatenate(rows), np.concatenate(cols), np.concatenate(coefs)
+    lower, upper = np.concatenate(lower), np.concatenate(upper)
+    keep = (np.bincount(rows, minlength= num_rows) > 0) | (lower > 0) | (upper < 0)
+    new_row = np.cumsum(keep) - 1
+
+    constraint_matrix = scipy_sparse.csr_matrix((coefs, (new_row[rows], cols)), shape= (int(keep.sum()), num_vars))
+
+    model = mbh.ModelBuilderHelper()
+    model.fill_model_from_sparse_data(np.zeros(num_vars), np.full(num_vars, np.inf), objective,
+                                      lower[keep], upper[keep], constraint_matrix)
+    if integer:
+        for var_index in range(num_vars):
+            model.set_var_integrality(var_index, True)
+    return model
+
+def task1_solution(solver, data, supplier_order_vars, production_vol_vars, customer_delivery_vars):
+    # overall cost and solution values of a solved pywraplp task1 model, variables that were not created are 0
+    S, M, F, P, C = len(data.suppliers), len(data.materials), len(data.factories), len(data.products), len(data.customers)
+    supplier_order = np.array([supplier_order_vars[supplier, material, factory].solution_value()
+                               if (supplier, material, factory) in supplier_order_vars else 0.0
+                               for supplier in data.suppliers for material in data.materials for factory in data.factories]).reshape(S, M, F)
+    production_vol = np.array([production_vol_vars[product, factory].solution_value()
+                               if (product, factory) in production_vol_vars else 0.0
+                               for product in data.products for factory in data.factories]).reshape(P, F)
+    customer_delivery = np.array([customer_delivery_vars[customer, product, factory].solution_value()
+                                  if (customer, product, factory) in customer_delivery_vars else 0.0
+                                  for customer in data.customers for product in data.products for factory in data.factories]).reshape(C, P, F)
+    return solver.Objective().Value(), supplier_order, production_vol, customer_delivery
+
+def solve_task1(data, builder= 'loop', sparse= False, profile= None, backend= None):
+    # Build and solve the task1 model, returns the overall cost and the solution values as arrays
+    # of shape (S, M, F), (P, F) and (C, P, F), or None if there is no optimal solution.
+    # backend is a SolverConfig or a backend name, GLOP by default which solves the LP relaxation
+    config = solver_config(backend, 'glop')
+    S, M, F, P, C = len(data.suppliers), len(data.materials), len(data.factories), len(data.products), len(data.customers)
+
+    if builder == 'loop':
+        with phase(profile, 'build'):
+            solver = create_solver(config)
+            supplier_order_vars, production_vol_vars, customer_delivery_vars, _ = build_task1_loop(solver, data, sparse)
+
+        # 8. Solve the linear program and determine the optimal overall cost
+        with phase(profile, 'solve'):
+            status, solve_time = run_solver(solver, config)
+        if profile is not None:
+            profile.add_solver('task1', solver_stats(solver, status, config, solve_time))
+        if status != pywraplp.Solver.OPTIMAL:
+            return None
+        with phase(profile, 'report'):
+            return task1_solution(solver, data, supplier_order_vars, production_vol_vars, customer_delivery_vars)
+
+    elif builder == 'matrix':
+        with phase(profile, 'build'):
+            model = build_task1_matrix(data, sparse, config.backend in MIP_BACKENDS)
+        with phase(profile, 'solve'):
+            solver = create_model_solver(config)
+            solve_time = run_model_solver(solver, model)
+        if profile is not None:
+            profile.add_solver('task1', model_solver_stats(model, solver, config, solve_time))
+        if solver.status() != mbh.SolveStatus.OPTIMAL:
+            return None
+        with phase(profile, 'report'):
+            values = solver.variable_values()
+            order_index, prod_index, delivery_index = task1_var_index(data, sparse)
+            supplier_order = np.where(order_index >= 0, values[order_index], 0.0)
+            production_vol = np.where(prod_index >= 0, values[prod_index], 0.0)
+            customer_delivery = np.where(delivery_index >= 0, values[delivery_index], 0.0)
+            return solver.objective_value(), supplier_order, production_vol, customer_delivery
+
+    raise ValueError(f"Unknown task1 model builder: {builder}")
+
+def compare_task1_builders(data, repeat= 3, sparse= False):
+    # Time the loop based and the matrix based model construction on the same data
+    for builder in ['loop', 'matrix']:
+        build_times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            if builder == 'loop':
+                build_task1_loop(pywraplp.Solver.CreateSolver("GLOP_LINEAR_PROGRAMMING"), data, sparse)
+            else:
+                build_task1_matrix(data, sparse)
+            build_times.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        solution = solve_task1(data, builder, sparse)
+        total_time = time.perf_counter() - start
+        overall_cost = solution[0] if solution is not None else None
+        print(f"{builder}: best build time {min(build_times):.4f}s, build and solve {total_time:.4f}s, overall cost {overall_cost}")
+
+# row and column labels of each task1 sheet
+TASK1_LABELS = {'supplier_stock': ('suppliers', 'materials'),
+                'raw_mat_costs': ('suppliers', 'materials'),
+                'raw_mat_ship': ('suppliers', 'factories'),
+                'prod_req': ('products', 'materials'),
+                'prod_cap': ('products', 'factories'),
+                'prod_cost': ('products', 'factories'),
+                'customer_demand': ('products', 'customers'),
+                'ship_cost': ('factories', 'customers')}
+
+class Task1Model:
+    # A task1 model that is built once and then re-solved for what-if questions.
+    # update() changes a single sheet value in place: right-hand sides for demand, stock and capacity,
+    # constraint coefficients for product requirements and objective coefficients for the costs.
+    # GLOP keeps the previous basis between solves, so a re-solve starts from the last optimum.
+
+    def __init__(self, data, sparse= False, backend= None):
+        self.data = data._replace(**{name: getattr(data, name).copy() for name in TASK1_LABELS})
+        self.sparse = sparse
+        self.config = solver_config(backend, 'glop')
+        self.build()
+
+    def build(self):
+        self.solver = create_solver(self.config)
+        self.supplier_order_vars, self.production_vol_vars, self.customer_delivery_vars, self.constraints =\
+            build_task1_loop(self.solver, self.data, self.sparse)
+
+    def update(self, name, row, col, value):
+        row_labels, col_labels = (getattr(self.data, labels) for labels in TASK1_LABELS[name])
+        array = getattr(self.data, name)
+        if array.dtype.kind == 'i' and value != int(value):
+            array = array.astype(np.float64)
+            self.data = self.data._replace(**{name: array})
+        i, j = row_labels.index(row), col_labels.index(col)
+        old_value = array[i, j]
+        array[i, j] = value
+
+        # the sparse model has no variables for zero entries, a change in the sparsity pattern needs a new model
+        if self.sparse and name in ['supplier_stock', 'prod_req', 'prod_cap', 'customer_demand'] and (old_value == 0) != (value == 0):
+            self.build()
+            return
+
+        objective = self.solver.Objective()
+        if name == 'customer_demand':
+            if (row, col) in self.constraints[name]:
+                self.constraints[name][row, col].SetLb(float(value))
+        elif name in ['supplier_stock', 'prod_cap']:
+            if (row, col) in self.constraints[name]:
+                self.constraints[name][row, col].SetUb(float(value))
+        elif name == 'prod_req':
+            for factory in self.data.factories:
+                if (col, factory) in self.constraints[name] and (row, factory) in self.production_vol_vars:
+                    self.constraints[name][col, factory].SetCoefficient(self.production_vol_vars[row, factory], -float(value))
+        elif name == 'raw_mat_costs':
+            for f, factory in enumerate(self.data.factories):
+                if (row, col, factory) in self.supplier_order_vars:
+                    objective.SetCoefficient(self.supplier_order_vars[row, col, factory], float(value + self.data.raw_mat_ship[i, f]))
+        elif name == 'raw_mat_ship':
+            for m, material in enumerate(self.data.materials):
+                if (row, material, col) in self.supplier_order_vars:
+                    objective.SetCoefficient(self.supplier_order_vars[row, material, col], float(self.data.raw_mat_costs[i, m] + value))
+        elif name == 'prod_cost':
+            if (row, col) in self.production_vol_vars:
+                objective.SetCoefficient(self.production_vol_vars[row, col], float(value))
+        elif name == 'ship_cost':
+            for product in self.data.products:
+                if (col, product, row) in self.customer_delivery_vars:
+                    objective.SetCoefficient(self.customer_delivery_vars[col, product, row], float(value))
+
+    def solve(self):
+        # same result as solve_task1 for the current data, the solver statistics are kept in self.stats
+        status, solve_time = run_solver(self.solver, self.config)
+        self.stats = solver_stats(self.solver, status, self.config, solve_time)
+        if status != pywraplp.Solver.OPTIMAL:
+            return None
+        return task1_solution(self.solver, self.data, self.supplier_order_vars, self.production_vol_vars, self.customer_delivery_vars)
+
+def task1_costs(data, production_vol, customer_delivery):
+    # manufacturing cost of each factory and shipping cost of each customer
+    manu_cost = (production_vol * data.prod_cost).sum(axis= 0)
+    customer_ship_cost = (customer_delivery * data.ship_cost.T[:, None, :]).sum(axis= (1, 2))
+    return manu_cost, customer_ship_cost
+
+# the Task1Model of a scenario worker process, built once from the base data by init_scenario_worker
+_scenario_model = None
+
+def init_scenario_worker(data, sparse, backend= None):
+    global _scenario_model
+    _scenario_model = Task1Model(data, sparse, backend)
+
+def run_scenario(updates):
+    # Apply the (sheet, row, col, value) updates of one scenario to the worker's model, solve it and
+    # put the base values back so the next scenario starts from the base data and the last basis
+    model = _scenario_model
+    old_values = []
+    for name, row, col, value in updates:
+        row_labels, col_labels = (getattr(model.data, labels) for labels in TASK1_LABELS[name])
+        old_values.append((name, row, col, getattr(model.data, name)[row_labels.index(row), col_labels.index(col)]))
+        model.update(name, row, col, value)
+
+    solution = model.solve()
+    result = [None] * (1 + len(model.data.factories) + len(model.data.customers))
+    if solution is not None:
+        overall_cost, supplier_order, production_vol, customer_delivery = solution
+        manu_cost, customer_ship_cost = task1_costs(model.data, production_vol, customer_delivery)
+        result = [overall_cost] + manu_cost.tolist() + customer_ship_cost.tolist()
+    result += stats_columns(model.stats)
+
+    for name, row, col, value in reversed(old_values):
+        model.update(name, row, col, value)
+    return result
+
+def run_task1_scenarios(data, scenarios, max_workers= None, sparse= False, csv_path= None, backend= None):
+    # Solve every scenario, a list of (sheet, row, col, value) updates to the base data, over a process pool.
+    # The base data is sent to each worker once when the pool starts, the scenarios only carry their updates.
+    # Returns the header and one row per scenario with the overall cost, the manufacturing cost of each
+    # factory, the shipping cost of each customer and the status, backend and time of the solve.
+    # A scenario without optimal solution has empty costs.
+    header = ['scenario', 'overall_cost'] + [f'manufacturing_cost[{factory}]' for factory in data.factories] +\
+             [f'shipping_cost[{customer}]' for customer in data.customers] + STATS_HEADER
+
+    if max_workers == 1 or len(scenarios) < 2:
+        init_scenario_worker(data, sparse, backend)
+        results = [run_scenario(updates) for updates in scenarios]
+    else:
+        max_workers = min(max_workers or os.cpu_count(), len(scenarios))
+        chunksize = max(1, len(scenarios) // (4 * max_workers))
+        with ProcessPoolExecutor(max_workers= max_workers, initializer= init_scenario_worker, initargs= (data, sparse, backend)) as executor:
+            results = list(executor.map(run_scenario, scenarios, chunksize= chunksize))
+
+    rows = [[i] + result for i, result in enumerate(results)]
+    if csv_path is not None:
+        write_csv(csv_path, header, rows)
+    return header, rows
+
+def task1_components(data):
+    # Presolve: split the supply chain into independent parts. Suppliers, materials, factories, products and
+    # customers are the nodes of a graph with an edge wherever a variable or a demand ties two of them together,
+    # using the same sparsity as task1_masks. No constraint spans two connected components, so each one can be
+    # solved on its own. Returns the index arrays {'suppliers': ..., 'materials': ..., ...} of every component
+    # with some customer demand, the others have nothing to produce and stay all zero.
+    S, M, F, P, C = len(data.suppliers), len(data.materials), len(data.factories), len(data.products), len(data.customers)
+    # the order and delivery variables of task1_masks only tie materials and factories that material_used
+    # already ties, and customers and products the demand already ties
+    prod_mask = data.prod_cap > 0
+    material_used = task1_material_used(data, prod_mask)
+    offsets = dict(zip(['suppliers', 'materials', 'factories', 'products', 'customers'], np.cumsum([0, S, M, F, P])))
+
+    edges = []
+    for labels1, labels2, mask in [('suppliers', 'materials', data.supplier_stock > 0),
+                                   ('materials', 'factories', material_used),
+                                   ('products', 'factories', prod_mask),
+                                   ('customers', 'products', data.customer_demand.T > 0)]:
+        i, j = np.nonzero(mask)
+        edges.append((offsets[labels1] + i, offsets[labels2] + j))
+    rows, cols = np.concatenate([i for i, j in edges]), np.concatenate([j for i, j in edges])
+    num_nodes = S + M + F + P + C
+    graph = scipy_sparse.csr_matrix((np.ones(rows.size), (rows, cols)), shape= (num_nodes, num_nodes))
+    num_components, labels = connected_components(graph, directed= False)
+
+    demanded = np.zeros(num_components, dtype= bool)
+    demanded[labels[offsets['products']:offsets['products'] + P][data.customer_demand.any(axis= 1)]] = True
+    components = []
+    for k in np.flatnonzero(demanded):
+        components.append({name: np.flatnonzero(labels[offset:offset + size] == k)
+                           for (name, offset), size in zip(offsets.items(), [S, M, F, P, C])})
+    return components
+
+def task1_subdata(data, index):
+    # the Task1Data of the suppliers, materials, ... with the given indices
+    return data._replace(**{name: [getattr(data, name)[i] for i in index[name]] for name in index},
+                         **{name: getattr(data, name)[np.ix_(index[rows], index[cols])] for name, (rows, cols) in TASK1_LABELS.items()})
+
+def solve_task1_component(args):
+    # solve_task1 on one component in a worker process, returns the solution and the solver statistics
+    data, builder, sparse, backend = args
+    # only the solver statistics are kept, so memory is not traced
+    profile = Profile(trace_memory= False)
+    return solve_task1(data, builder, sparse, profile, backend), profile.solvers
+
+def solve_task1_components(data, builder= 'loop', sparse= False, profile= None, backend= None, max_workers= None):
+    # Same result as solve_task1, but each component of task1_components is solved as its own model,
+    # on a process pool when there are several, and the solutions are merged back into the full arrays.
+    # Variables that task1_masks leaves out are 0 here even with sparse=False, which only matters where a
+    # zero cost makes them a tie.
+    S, M, F, P, C = len(data.suppliers), len(data.materials), len(data.factories), len(data.products), len(data.customers)
+    with phase(profile, 'presolve'):
+        components = task1_components(data)
+        tasks = [(task1_subdata(data, index), builder, sparse, backend) for index in components]
+
+    with phase(profile, 'solve'):
+        if max_workers == 1 or len(tasks) < 2:
+            results = [solve_task1_component(task) for task in tasks]
+        else:
+            with ProcessPoolExecutor(max_workers= min(max_workers or os.cpu_count(), len(tasks))) as executor:
+                results = list(executor.map(solve_task1_component, tasks))
+
+    # the first component without an optimal solution decides the status
+    status = next((stats[-1]['status'] for solution, stats in results if solution is None), 'optimal')
+    if profile is not None:
+        for k, (solution, stats) in enumerate(results):
+            for record in stats:
+                profile.add_solver(f"{record['name']}[{k}]", {key: value for key, value in record.items() if key != 'name'})
+        profile.add_solver('task1', {'backend': 'components', 'status': status, 'components': len(results)})
+    if status != 'optimal':
+        return None
+
+    with phase(profile, 'report'):
+        overall_cost = 0.0
+        supplier_order = np.zeros((S, M, F))
+        production_vol = np.zeros((P, F))
+        customer_delivery = np.zeros((C, P, F))
+        for index, ((objective, order, production, delivery), _) in zip(components, results):
+            s, m, f, p, c = (index[name] for name in ['suppliers', 'materials', 'factories', 'products', 'customers'])
+            overall_cost += objective
+            supplier_order[np.ix_(s, m, f)] = order
+            production_vol[np.ix_(p, f)] = production
+            customer_delivery[np.ix_(c, p, f)] = delivery
+        return overall_cost, supplier_order, production_vol, customer_delivery
+
+def task1_report_tables(data, supplier_order, production_vol, customer_delivery):
+    # The task1 report steps 9 to 13 as tables, computed with array reductions over the solution arrays.
+    # Returns {name: (header, rows)}, amounts and costs are rounded to whole units like the printed report.
+    suppliers, materials, factories, products, customers = data.suppliers, data.materials, data.factories, data.products, data.customers
+    order_amount = np.rint(supplier_order).astype(int)
+    production_amount = np.rint(production_vol).astype(int)
+    delivery_amount = np.rint(customer_delivery).astype(int)
+    tables = {}
+
+    # 9. how much material each factory orders from each individual supplier
+    index = np.argwhere(order_amount.transpose(2, 1, 0) != 0)
+    tables['orders'] = (['factory', 'material', 'supplier', 'amount'],
+                        [[factories[f], materials[m], suppliers[s], int(order_amount[s, m, f])] for f, m, s in index.tolist()])
+
+    # 10. the bill of each supplier for each factory, material cost plus delivery
+    billing = np.rint((supplier_order * data.raw_mat_costs[:, :, None]).sum(axis= 1) +
+                      supplier_order.sum(axis= 1) * data.raw_mat_ship).astype(int)
+    index = np.argwhere(billing.T != 0)
+    tables['bills'] = (['factory', 'supplier', 'billing'],
+                       [[factories[f], suppliers[s], int(billing[s, f])] for f, s in index.tolist()])
+
+    # 11. units of each product manufactured in each factory and the manufacturing cost of each factory
+    index = np.argwhere(production_amount.T != 0)
+    tables['production'] = (['factory', 'product', 'amount'],
+                            [[factories[f], products[p], int(production_amount[p, f])] for f, p in index.tolist()])
+    manu_cost = np.rint((production_vol * data.prod_cost).sum(axis= 0)).astype(int)
+    tables['manufacturing_cost'] = (['factory', 'cost'], [list(row) for row in zip(factories, manu_cost.tolist())])
+
+    # 12. units of each product shipped from each factory to each customer and the shipping cost of each customer
+    index = np.argwhere(delivery_amount != 0)
+    tables['deliveries'] = (['customer', 'product', 'factory', 'amount'],
+                            [[customers[c], products[p], factories[f], int(delivery_amount[c, p, f])] for c, p, f in index.tolist()])
+    total_ship_cost = np.rint((customer_delivery * data.ship_cost.T[:, None, :]).sum(axis= (1, 2))).astype(int)
+    tables['shipping_cost'] = (['customer', 'cost'], [list(row) for row in zip(customers, total_ship_cost.tolist())])
+
+    # 13. material each factory orders for the products delivered to each customer
+    pair = np.argwhere(data.prod_req[index[:, 1]] != 0)
+    c, p, f = index[pair[:, 0]].T
+    m = pair[:, 1]
+    prod_amount = delivery_amount[c, p, f]
+    tables['material_orders'] = (['customer', 'product', 'factory', 'material', 'product_amount', 'material_amount'],
+                                 [list(row) for row in zip([customers[i] for i in c.tolist()], [products[i] for i in p.tolist()],
+                                                           [factories[i] for i in f.tolist()], [materials[i] for i in m.tolist()],
+                                                           prod_amount.tolist(), (prod_amount * data.prod_req[p, m]).tolist())])
+
+    # and the unit cost of each product per customer: raw materials at the average price the factory paid,
+    # manufacturing and shipping
+    total_mat_cost = np.rint((supplier_order * (data.raw_mat_costs[:, :, None] + data.raw_mat_ship[:, None, :])).sum(axis= 0))
+    total_mat_amount = np.rint(supplier_order.sum(axis= 0))
+    unit_mat_cost = np.divide(total_mat_cost, total_mat_amount, out= np.zeros(total_mat_cost.shape), where= total_mat_amount != 0)
+    total_cost = np.einsum('cpf,pm,mf->cp', customer_delivery, data.prod_req, unit_mat_cost) +\
+                 (customer_delivery * (data.prod_cost[None, :, :] + data.ship_cost.T[:, None, :])).sum(axis= 2)
+    product_count = np.rint(customer_delivery.sum(axis= 2))
+    index = np.argwhere(product_count != 0)
+    tables['unit_cost'] = (['customer', 'product', 'unit_cost'],
+                           [[customers[c], products[p], float(total_cost[c, p] / product_count[c, p])] for c, p in index.tolist()])
+
+    return tables
+
+def write_task1_report(directory, tables):
+    # one csv file per report table
+    os.makedirs(directory, exist_ok= True)
+    for name, (header, rows) in tables.items():
+        write_csv(os.path.join(directory, f"task1_{name}.csv"), header, rows)
+
+def print_task1_report(data, overall_cost, supplier_order, production_vol, customer_delivery, tables= None):
+    if tables is None:
+        tables = task1_report_tables(data, supplier_order, production_vol, customer_delivery)
+
+    def rows_by(name):
+        grouped = {}
+        for row in tables[name][1]:
+            grouped.setdefault(row[0], []).append(row)
+        return grouped
+
+    print(f"Overall Cost: {overall_cost}")
+
+    print("\n")
     # 9. Determine for each factory how much material has to be ordered from each individual supplier
-        for factory in factories:
-            for material in materials:
-                for supplier in suppliers:
-                    if int(round(supplier_order_vars[supplier, material, factory].solution_value())) != 0:
-                        print(f"{factory} orders {material} from {supplier} for {int(round(supplier_order_vars[supplier, material, factory].solution_value()))}")
-        
-        print("\n")
+    for factory, material, supplier, amount in tables['orders'][1]:
+        print(f"{factory} orders {material} from {supplier} for {amount}")
+    
+    print("\n")
     # 10. Determine for each factory what the supplier bill comprising material cost and delivery will be for each supplier
-        for factory in factories:
-            for supplier in suppliers:
-                billing = int(round(sum([supplier_order_vars[supplier, material, factory].solution_value() * raw_mat_costs[supplier, material] for material in materials]) +\
-                        sum([supplier_order_vars[supplier, material, factory].solution_value() *  raw_mat_ship[supplier, factory] for material in materials])))
-                if billing != 0:
-                    print(f"For {factory}, {supplier} bills {billing}")
+    for factory, supplier, billing in tables['bills'][1]:
+        print(f"For {factory}, {supplier} bills {billing}")
 
     # 11. Determine for each factory how many units of each product are being manufactured. 
     # Also determine the total manufacturing cost for each individual factory.
-        print("\n")
-        for factory in factories:
-            for product in products:
-                if int(round(production_vol_vars[product, factory].solution_value())) != 0:
-                    print(f"{factory} manufactured {product} for {int(round(production_vol_vars[product, factory].solution_value()))}")
-            
-            manu_cost = int(round(sum([production_vol_vars[product, factory].solution_value() * prod_cost[product, factory]\
-                                        for product in products])))
-            print(f"Overall manufacturing cost of {factory} is {manu_cost}")
+    print("\n")
+    production = rows_by('production')
+    for factory, manu_cost in tables['manufacturing_cost'][1]:
+        for _, product, amount in production.get(factory, []):
+            print(f"{factory} manufactured {product} for {amount}")
+        print(f"Overall manufacturing cost of {factory} is {manu_cost}")
     
     # 12. Determine for each customer how many units of each product are being shipped from eachfactory
     # Also determine the total shipping cost per customer.
-        print("\n")
-        for customer in customers:
-            for product in products:
-                for factory in factories:
-                    if int(round(customer_delivery_vars[customer, product, factory].solution_value())) != 0:
-                        print(f"To {customer}, {int(round(customer_delivery_vars[customer, product, factory].solution_value()))} of {product} are shipped from {factory}")
-            
-            total_ship_cost = int(round(sum(
-                [customer_delivery_vars[customer, product, factory].solution_value() * ship_cost[factory, customer]\
-                 for product in products for factory in factories]
-            )))
-            print(f'Total Shipping Cost for {customer} is {total_ship_cost}')
+    print("\n")
+    deliveries = rows_by('deliveries')
+    for customer, total_ship_cost in tables['shipping_cost'][1]:
+        for _, product, factory, amount in deliveries.get(customer, []):
+            print(f"To {customer}, {amount} of {product} are shipped from {factory}")
+        print(f'Total Shipping Cost for {customer} is {total_ship_cost}')
     
     # 13. Determine for each customer the fraction of each material each factory has to order for manufacturing products delivered to that particular customer. 
     # Based on this calculate the overall unit cost of each product per customer including the raw materials used for the manufacturing of the customer’s specific product, 
     # the cost of manufacturing for the specific customer and all relevant shipping costs.
-        print("\n")
-        unit_mat_cost = {}
-        for factory in factories:
-            for material in materials:
-                total_mat_cost = int(round(sum([supplier_order_vars[supplier, material, factory].solution_value() * raw_mat_costs[supplier, material]\
-                                                          for supplier in suppliers]) +\
-                                                    sum([supplier_order_vars[supplier, material, factory].solution_value() * raw_mat_ship[supplier, factory]\
-                                                          for supplier in suppliers])))
-                total_mat_amount = int(round(sum([supplier_order_vars[supplier, material, factory].solution_value()\
-                                                                            for supplier in suppliers])))
-                unit_mat_cost[material, factory] = float(total_mat_cost) / float(total_mat_amount) if total_mat_amount != 0 else 0
-                
-        for customer in customers:
-            for product in products:
-                for factory in factories:
-                    if int(round(customer_delivery_vars[customer, product, factory].solution_value())) != 0:
-                        prod_amount = int(round(customer_delivery_vars[customer, product, factory].solution_value()))
-                        for material in materials:
-                            if prod_req[product, material] != 0:
-                                mat_amount = prod_amount * prod_req[product, material]
-                                print(f"To {customer}, to deliver {prod_amount} {product}, {factory} orders {material} for {mat_amount}")
-        
-        print("\n")
-        for customer in customers:
-            for product in products:
-                product_count = int(round(sum(customer_delivery_vars[customer, product, factory].solution_value() for factory in factories)))
-                if product_count != 0:
-                    total_mat_cost = sum(customer_delivery_vars[customer, product, factory].solution_value() * prod_req[product, material] * unit_mat_cost[material, factory]\
-                                         for factory in factories for material in materials)
-                    total_prod_cost = sum(customer_delivery_vars[customer, product, factory].solution_value() * prod_cost[product, factory] \
-                                          for factory in factories) +\
-                                        sum(customer_delivery_vars[customer, product, factory].solution_value() * ship_cost[factory, customer] \
-                                            for factory in factories)
-                    total_cost = total_mat_cost + total_prod_cost
-                    print(f"{customer}, {product}: {total_cost/product_count:.2f}")
+    print("\n")
+    for customer, product, factory, material, prod_amount, mat_amount in tables['material_orders'][1]:
+        print(f"To {customer}, to deliver {prod_amount} {product}, {factory} orders {material} for {mat_amount}")
+    
+    print("\n")
+    for customer, product, unit_cost in tables['unit_cost'][1]:
+        print(f"{customer}, {product}: {unit_cost:.2f}")
 
+def task1(builder= 'loop', sparse= False, xlsx_path= 'Assignment_DA_2_Task_1_data.xlsx', profile= None, verbose= True, report_dir= None,
+          backend= None, decompose= False, max_workers= None):
+    # Solve task1 and return the result as a dict, verbose prints the full report as well
+    # and report_dir exports the report tables as csv files. backend is passed on to solve_task1,
+    # decompose solves the independent components of the supply chain separately on up to max_workers processes
+    profile = profile if profile is not None else Profile()
+    config = solver_config(backend, 'glop')
+    result = {'task': 'task1', 'parameters': {'builder': builder, 'sparse': sparse, 'xlsx_path': xlsx_path, 'backend': config._asdict(),
+                                              'decompose': decompose}}
+
+    # 1. Load the xlsx file
+    with profile.phase('load'):
+        data = load_task1_data(xlsx_path)
+        key = data_key('task1', builder, sparse, config, decompose, *data)
+        cached = load_result(key)
+
+    # an unchanged workbook is not solved again
+    if cached is not None:
+        status = cached['status']
+        solution = None
+        if status == 'optimal':
+            S, M, F, P, C = (len(labels) for labels in data[:5])
+            solution = (cached['solution'][0], *(np.array(values, dtype= np.float64).reshape(shape) for values, shape
+                                                 in zip(cached['solution'][1:], [(S, M, F), (P, F), (C, P, F)])))
     else:
-        print("The problem does not have an optimal solution.")
+        if decompose:
+            solution = solve_task1_components(data, builder, sparse, profile, config, max_workers)
+        else:
+            solution = solve_task1(data, builder, sparse, profile, config)
+        status = 'optimal' if solution is not None else profile.solvers[-1]['status']
+        if definitive(status, config.time_limit):
+            store_result(key, {'status': status, 'solution': solution})
 
-def task2():
+    with profile.phase('report'):
+        result['status'] = status
+        result['cached'] = cached is not None
+        if solution is not None:
+            overall_cost, supplier_order, production_vol, customer_delivery = solution
+            manu_cost, customer_ship_cost = task1_costs(data, production_vol, customer_delivery)
+            result['overall_cost'] = overall_cost
+            result['manufacturing_cost'] = dict(zip(data.factories, manu_cost.tolist()))
+            result['shipping_cost'] = dict(zip(data.customers, customer_ship_cost.tolist()))
+            if verbose or report_dir is not None:
+                tables = task1_report_tables(data, supplier_order, production_vol, customer_delivery)
+            if report_dir is not None:
+                write_task1_report(report_dir, tables)
 
-    solver = pywraplp.Solver.CreateSolver("CBC_MIXED_INTEGER_PROGRAMMING")
-    
-    # 1. Load the xlsx file
-    xlsx_file = load_workbook('Assignment_DA_2_Task_2_data.xlsx', read_only= True)
-    distance_sheet = xlsx_file['Distances']
-    distance = {}
-    load_sheet(distance_sheet, distance)
-    
-    towns_to_visit = ['Cork', 'Dublin', 'Limerick', 'Waterford', 'Galway', 'Wexford', 'Belfast', 'Athlone', 'Rosslare', 'Wicklow']
+        if verbose:
+            if solution is not None:
+                print_task1_report(data, *solution, tables= tables)
+            else:
+                print("The problem does not have an optimal solution.")
+
+    result['profile'] = profile.as_dict()
+    return result
+
+def find_subtours(successor):
+    # follow the successor array from each unvisited town and collect every closed cycle, in linear time
+    subtours = []
+    visited = np.zeros(len(successor), dtype= bool)
+    for town in range(len(successor)):
+        if visited[town]:
+            continue
+        cycle = []
+        current_town = town
+        while not visited[current_town]:
+            visited[current_town] = True
+            cycle.append(current_town)
+            current_town = successor[current_town]
+        subtours.append(cycle)
+    return subtours
+
+def mip_successors(legs, num_towns):
+    # successor[i] is the town the chosen legs go to from town i
+    successor = np.full(num_towns, -1)
+    for (town1, town2), leg in legs.items():
+        if leg.solution_value() > 0.5:
+            successor[town1] = town2
+    return successor
+
+def tour_successors(tour):
+    successor = np.empty(len(tour), dtype= int)
+    successor[tour] = np.roll(tour, -1)
+    return successor
+
+def tour_length(distance_matrix, tour):
+    return distance_matrix[tour, np.roll(tour, -1)].sum()
+
+def nearest_neighbour_tour(distance_matrix, start= 0):
+    # construction heuristic: always drive on to the closest town not visited yet
+    unvisited = np.ones(len(distance_matrix), dtype= bool)
+    unvisited[start] = False
+    tour = [start]
+    for _ in range(len(distance_matrix) - 1):
+        next_town = int(np.where(unvisited, distance_matrix[tour[-1]], np.inf).argmin())
+        unvisited[next_town] = False
+        tour.append(next_town)
+    return np.array(tour)
+
+def two_opt(distance_matrix, tour):
+    # Replace the pair of legs (a, b), (c, d) by (a, c), (b, d) and reverse the route between them
+    # for the best improving pair until there is none. Only valid for symmetric distances.
+    n = len(tour)
+    improved = False
+    allowed = np.triu(np.ones((n, n), dtype= bool), 2)
+    allowed[0, n - 1] = False
+    while True:
+        a = tour
+        b = np.roll(tour, -1)
+        leg = distance_matrix[a, b]
+        delta = distance_matrix[a[:, None], a[None, :]] + distance_matrix[b[:, None], b[None, :]] - leg[:, None] - leg[None, :]
+        delta = np.where(allowed, delta, 0)
+        i, j = np.unravel_index(delta.argmin(), delta.shape)
+        if delta[i, j] >= -1e-9:
+            return tour, improved
+        tour = np.concatenate([tour[:i + 1], tour[i + 1:j + 1][::-1], tour[j + 1:]])
+        improved = True
+
+def or_opt(distance_matrix, tour, max_segment= 3):
+    # Move a segment of up to max_segment towns, in its driving direction, to the cheapest other place
+    # in the route while that shortens the route. The first town of the tour stays first.
+    n = len(tour)
+    improved = False
+    moved = True
+    while moved:
+        moved = False
+        for length in range(1, min(max_segment, n - 2) + 1):
+            for i in range(1, n - length + 1):
+                segment = tour[i:i + length]
+                rest = np.concatenate([tour[:i], tour[i + length:]])
+                previous_town, next_town = tour[i - 1], tour[(i + length) % n]
+                gain = distance_matrix[previous_town, segment[0]] + distance_matrix[segment[-1], next_town] - distance_matrix[previous_town, next_town]
+                u = rest
+                v = np.roll(rest, -1)
+                cost = distance_matrix[u, segment[0]] + distance_matrix[segment[-1], v] - distance_matrix[u, v]
+                k = int(cost.argmin())
+                if cost[k] < gain - 1e-9:
+                    tour = np.concatenate([rest[:k + 1], segment, rest[k + 1:]])
+                    moved = improved = True
+                    break
+            if moved:
+                break
+    return tour, improved
+
+def heuristic_tour(distance_matrix):
+    # nearest neighbour construction followed by 2-opt and Or-opt local search until neither improves
+    tour = nearest_neighbour_tour(distance_matrix)
+    if len(tour) < 4:
+        return tour
+    symmetric = np.array_equal(distance_matrix, distance_matrix.T)
+    improved = True
+    while improved:
+        improved = False
+        if symmetric:
+            tour, improved = two_opt(distance_matrix, tour)
+        tour, moved = or_opt(distance_matrix, tour)
+        improved = improved or moved
+    return tour
+
+def routing_tour(distance_matrix, time_limit= None):
+    # Tour of OR-Tools' routing solver for one vehicle starting at the first town. With a time limit
+    # guided local search keeps improving the tour until the limit, without one the first local optimum is returned.
+    manager = pywrapcp.RoutingIndexManager(len(distance_matrix), 1, 0)
+    routing = pywrapcp.RoutingModel(manager)
+    transit = routing.RegisterTransitMatrix(np.rint(distance_matrix).astype(int).tolist())
+    routing.SetArcCostEvaluatorOfAllVehicles(transit)
+
+    parameters = pywrapcp.DefaultRoutingSearchParameters()
+    parameters.first_solution_strategy = routing_enums_pb2.FirstSolutionStrategy.PATH_CHEAPEST_ARC
+    if time_limit is not None:
+        parameters.local_search_metaheuristic = routing_enums_pb2.LocalSearchMetaheuristic.GUIDED_LOCAL_SEARCH
+        parameters.time_limit.FromMilliseconds(int(time_limit * 1000))
+
+    solution = routing.SolveWithParameters(parameters)
+    if solution is None:
+        return None
+    tour = []
+    index = routing.Start(0)
+    while not routing.IsEnd(index):
+        tour.append(manager.IndexToNode(index))
+        index = solution.Value(routing.NextVar(index))
+    return np.array(tour)
+
+def build_task2_mip(solver, distance_matrix, subtour):
+    # The towns are the rows of distance_matrix, legs[i, j] is the leg from town i to town j
+    towns = range(len(distance_matrix))
 
     # 2. For each pair of towns that need to be visited create a decision variable to decide if this leg should be included into the route
     legs = {}
 
-    for town1 in towns_to_visit:
-        for town2 in towns_to_visit:
+    for town1 in towns:
+        for town2 in towns:
             if town1 != town2:
                 legs[town1, town2] = solver.IntVar(0, 1, "")
     
-    for town in towns_to_visit:
+    for town in towns:
     # 3. Define and implement the constraints that ensure that the delivery driver arrives in each of the towns that need to be visited
-        solver.Add(sum(legs[town, town2] for town2 in towns_to_visit if town2 != town) == 1)
+        solver.Add(sum(legs[town, town2] for town2 in towns if town2 != town) == 1)
     
     # 4. Define and implement the constraints that ensure that the driver departs each of the towns that need to be visited
-        solver.Add(sum(legs[town1, town] for town1 in towns_to_visit if town != town1) == 1)
+        solver.Add(sum(legs[town1, town] for town1 in towns if town != town1) == 1)
     
     # 5. Define and implement the constraints that ensure that there are no disconnected selfcontained circles in the route
-    subtowns = [subtown for i in range(2, len(towns_to_visit)) for subtown in combinations(towns_to_visit, i)]
-        
-    for subtown in subtowns:
-        solver.Add(sum(legs[town1, town2] for town1 in subtown for town2 in subtown if town1 != town2) <= len(subtown) - 1)
+    # 'full' enumerates every subset of towns (about 2^n constraints, only usable for a handful of towns),
+    # 'mtz' uses the compact Miller-Tucker-Zemlin ordering variables (n^2 constraints),
+    # 'lazy' starts without any cuts and only adds them for the subtours that show up in a solution
+    if subtour == 'full':
+        subtowns = [subtown for i in range(2, len(towns)) for subtown in combinations(towns, i)]
+            
+        for subtown in subtowns:
+            solver.Add(sum(legs[town1, town2] for town1 in subtown for town2 in subtown if town1 != town2) <= len(subtown) - 1)
+    elif subtour == 'mtz':
+        # order[town] is the position of the town in the route, the first town is fixed at position 0
+        n = len(towns)
+        order = {}
+        for town in towns[1:]:
+            order[town] = solver.NumVar(1, n - 1, "")
+        for town1 in towns[1:]:
+            for town2 in towns[1:]:
+                if town1 != town2:
+                    solver.Add(order[town1] - order[town2] + n * legs[town1, town2] <= n - 1)
+    elif subtour != 'lazy':
+        raise ValueError(f"Unknown subtour elimination mode: {subtour}")
     
     # 6. Define and implement the objective function to minimise the overall distance travelled.
-    overall_distance = sum(legs[town1, town2] * distance[town1, town2] for town1 in towns_to_visit for town2 in towns_to_visit if town1 != town2)
+    overall_distance = sum(leg * float(distance_matrix[town1, town2]) for (town1, town2), leg in legs.items())
     solver.Minimize(overall_distance)
 
-    status = solver.Solve()
+    return legs
 
-    if status == pywraplp.Solver.OPTIMAL:
-        print(f"Overall Distance: {solver.Objective().Value()}")
-        print("\n")
+def solve_task2_mip(solver, legs, num_towns, subtour, config, time_limit= None):
+    # Solve the MIP, re-solving with subtour cuts in lazy mode, within time_limit seconds overall.
+    # Returns the status, the successor array of the last solution (None without one), the number of solves
+    # and their total time.
+    deadline = time.perf_counter() + time_limit if time_limit is not None else None
+    rounds = 0
+    solve_time = 0.0
+    while True:
+        if deadline is not None:
+            solver.SetTimeLimit(max(1, int((deadline - time.perf_counter()) * 1000)))
+        status, round_time = run_solver(solver, config)
+        rounds += 1
+        solve_time += round_time
+        if status not in [pywraplp.Solver.OPTIMAL, pywraplp.Solver.FEASIBLE]:
+            return status, None, rounds, solve_time
+        successor = mip_successors(legs, num_towns)
+        if subtour != 'lazy':
+            return status, successor, rounds, solve_time
 
-        current_town = 'Cork'
-        while True:
-            next_town = next(town2 for town2 in towns_to_visit if town2 != current_town and legs[current_town, town2].solution_value() > 0)
-            print(current_town, '->', next_town, ':', distance[current_town, next_town])
-            current_town = next_town
+        # Re-solve with a cut for every disconnected circle in the solution until the route is a single tour
+        subtours = find_subtours(successor)
+        if len(subtours) == 1 or (deadline is not None and time.perf_counter() >= deadline):
+            return status, successor, rounds, solve_time
+        for subtown in subtours:
+            solver.Add(sum(legs[town1, town2] for town1 in subtown for town2 in subtown if town1 != town2) <= len(subtown) - 1)
 
-            if current_town == 'Cork':
-                break
+def solve_route(distance_matrix, subtour= 'lazy', engine= 'mip', time_limit= None, warm_start= False, profile= None, backend= None):
+    # Shortest round trip through all rows of distance_matrix, starting at the first one.
+    # engine picks the routing engine: 'heuristic' (nearest neighbour with 2-opt and Or-opt), 'routing'
+    # (OR-Tools' routing solver, guided local search within time_limit seconds) or 'mip' (the exact model,
+    # optionally within time_limit seconds and warm started from the heuristic tour).
+    # backend is the SolverConfig or backend name of the MIP, CBC by default; its time limit applies when time_limit is None.
+    # Returns the status, the tour as an array of row indices (None without one) and the optimality gap when it is known.
+    profile = profile if profile is not None else Profile()
+    config = solver_config(backend, 'cbc')
+    if engine not in ['mip', 'heuristic', 'routing']:
+        raise ValueError(f"Unknown routing engine: {engine}")
+    if engine == 'mip' and config.backend not in MIP_BACKENDS:
+        raise ValueError(f"The task2 MIP needs a MIP backend, not {config.backend}")
+    # SCIP's concurrent solve cannot be re-solved after the lazy subtour cuts are added
+    if engine == 'mip' and subtour == 'lazy' and config.backend == 'scip' and (config.threads or 1) > 1:
+        raise ValueError("Lazy subtour cuts need a single threaded SCIP, use subtour= 'mtz' or the cp-sat backend")
+    time_limit = time_limit if time_limit is not None else config.time_limit
+
+    tour = None
+    gap = None
+    if engine in ['heuristic', 'routing'] or warm_start:
+        with profile.phase('solve'):
+            start = time.perf_counter()
+            tour = heuristic_tour(distance_matrix) if engine != 'routing' else routing_tour(distance_matrix, time_limit)
+            profile.add_solver(engine if engine == 'routing' else 'heuristic',
+                               {'backend': engine if engine == 'routing' else 'heuristic', 'status': 'feasible' if tour is not None else 'not_solved',
+                                'wall_time': time.perf_counter() - start, 'solve_time': time.perf_counter() - start})
+        status = 'feasible' if tour is not None else 'not_solved'
+    if engine != 'mip':
+        return status, tour, gap
+
+    with profile.phase('build'):
+        solver = create_solver(config)
+        legs = build_task2_mip(solver, distance_matrix, subtour)
+        if tour is not None:
+            # the heuristic tour is a hint for the solver and its length an upper bound on the optimum
+            successor = tour_successors(tour)
+            solver.SetHint([legs[i, j] for i, j in enumerate(successor)], [1.0] * len(successor))
+            solver.Add(sum(leg * float(distance_matrix[town1, town2]) for (town1, town2), leg in legs.items())
+                       <= float(tour_length(distance_matrix, tour)))
+
+    with profile.phase('solve'):
+        mip_status, successor, rounds, solve_time = solve_task2_mip(solver, legs, len(distance_matrix), subtour, config, time_limit)
+    profile.add_solver('task2', dict(solver_stats(solver, mip_status, config, solve_time), rounds= rounds))
+
+    if successor is not None and len(find_subtours(successor)) == 1:
+        tour = np.zeros(len(successor), dtype= int)
+        for i in range(1, len(successor)):
+            tour[i] = successor[tour[i - 1]]
+        status = STATUS_NAMES.get(mip_status, str(mip_status))
+        objective = solver.Objective().Value()
+        gap = 0.0 if mip_status == pywraplp.Solver.OPTIMAL else (objective - solver.Objective().BestBound()) / objective
+    elif tour is not None and mip_status != pywraplp.Solver.INFEASIBLE:
+        # no complete tour from the MIP within the time limit, keep the heuristic tour
+        bound = solver.Objective().BestBound()
+        gap = (tour_length(distance_matrix, tour) - bound) / tour_length(distance_matrix, tour) if np.isfinite(bound) else None
     else:
-        print('The problem does not have an optimal solution')
+        tour = None
+        # a lazy solve stopped by the time limit while its solution still has subtours has no route yet
+        status = STATUS_NAMES.get(mip_status, str(mip_status)) if successor is None else 'not_solved'
+    return status, tour, gap
 
-def task3(currency= 'USD'):
+def route_legs(towns, distance_matrix, tour):
+    # (town1, town2, distance) of each leg of the tour, walking it from its first town
+    return [(towns[i], towns[j], distance_matrix[i, j].item()) for i, j in zip(tour.tolist(), np.roll(tour, -1).tolist())]
+
+def task2(towns_to_visit= None, subtour= 'lazy', xlsx_path= 'Assignment_DA_2_Task_2_data.xlsx', profile= None, verbose= True,
+          engine= 'mip', time_limit= None, warm_start= False, backend= None):
+    # Solve task2 and return the result as a dict, verbose prints the route as well.
+    # engine, time_limit, warm_start and backend are passed on to solve_route, the result has the optimality gap when it is known.
+    profile = profile if profile is not None else Profile()
+    config = solver_config(backend, 'cbc')
 
     # 1. Load the xlsx file
-    xlsx_file = load_workbook('Assignment_DA_2_Task_3_data.xlsx', read_only= True)
+    with profile.phase('load'):
+        table = load_table(xlsx_path, 'Distances', dtype= int)
+    
+    if towns_to_visit is None:
+        towns_to_visit = ['Cork', 'Dublin', 'Limerick', 'Waterford', 'Galway', 'Wexford', 'Belfast', 'Athlone', 'Rosslare', 'Wicklow']
+    result = {'task': 'task2', 'parameters': {'towns_to_visit': towns_to_visit, 'subtour': subtour, 'xlsx_path': xlsx_path,
+                                              'engine': engine, 'time_limit': time_limit, 'warm_start': warm_start,
+                                              'backend': config._asdict()}}
+    distance_matrix = table_array(table, towns_to_visit, towns_to_visit)
+    np.fill_diagonal(distance_matrix, 0)
+
+    # the same towns with the same distances are not solved again
+    key = data_key('task2', towns_to_visit, subtour, engine, time_limit, warm_start, config, distance_matrix)
+    cached = load_result(key)
+    if cached is not None:
+        status, tour, gap = cached['status'], cached['tour'], cached['gap']
+        tour = np.array(tour, dtype= int) if tour is not None else None
+    else:
+        status, tour, gap = solve_route(distance_matrix, subtour, engine, time_limit, warm_start, profile, config)
+        if definitive(status, time_limit if time_limit is not None else config.time_limit):
+            store_result(key, {'status': status, 'tour': tour, 'gap': gap})
 
-    usd_sheet = xlsx_file['USD']
-    eur_sheet = xlsx_file['EUR']
-    currency_sheet = xlsx_file['Currency']
+    with profile.phase('report'):
+        result['status'] = status
+        result['cached'] = cached is not None
+        if tour is not None:
+            result['overall_distance'] = float(tour_length(distance_matrix, tour))
+            result['gap'] = gap
+            result['legs'] = route_legs(towns_to_visit, distance_matrix, tour)
 
-    usd_data = {}
-    load_sheet_3(usd_sheet, usd_data)
+        if verbose:
+            print_task2_report(result)
 
-    eur_data = {}
-    load_sheet_3(eur_sheet, eur_data)
+    result['profile'] = profile.as_dict()
+    return result
 
-    currency_data = {}
-    load_sheet_3(currency_sheet, currency_data)
+def print_task2_report(result):
+    if 'legs' in result:
+        print(f"Overall Distance: {result['overall_distance']}")
+        print("\n")
+
+        for town1, town2, leg_distance in result['legs']:
+            print(town1, '->', town2, ':', leg_distance)
+    else:
+        print('The problem does not have an optimal solution')
+
+# the distance matrix of all towns of a route worker process
+_route_distances = None
+
+def init_route_worker(distance_matrix):
+    global _route_distances
+    _route_distances = distance_matrix
+
+def solve_route_request(request, distance_matrix= None):
+    # Solve the round trip through the towns with the given row indices of the full distance matrix.
+    # Returns the status, the tour in row indices of the full matrix, the gap and the statistics of every solve.
+    indices, subtour, engine, time_limit, warm_start, backend = request
+    distance_matrix = distance_matrix if distance_matrix is not None else _route_distances
+    if len(indices) < 2:
+        return 'optimal', indices, 0.0, []
+    # only the solver statistics are kept; tracemalloc state is global to the process, so in thread mode
+    # traced phases of concurrent requests would mix anyway
+    profile = Profile(trace_memory= False)
+    status, tour, gap = solve_route(distance_matrix[np.ix_(indices, indices)], subtour, engine, time_limit, warm_start, profile, backend)
+    return status, (indices[tour] if tour is not None else None), gap, profile.solvers
+
+class RouteService:
+    # Long lived task2 router. The distance sheet is loaded once into an array indexed by town number,
+    # requests for any subset of the towns are solved on a pool of threads or processes and the solved
+    # tours are kept in an LRU cache keyed by the sorted town numbers, so the same set of towns in any
+    # order is only solved once. Concurrent requests for a set that is being solved wait for that solve.
+    def __init__(self, xlsx_path= 'Assignment_DA_2_Task_2_data.xlsx', subtour= 'lazy', engine= 'mip', time_limit= None,
+                 warm_start= False, max_workers= None, processes= False, cache_size= 1024, backend= None):
+        table = load_table(xlsx_path, 'Distances', dtype= int)
+        self.towns = list(table.rows)
+        self.town_index = {town: i for i, town in enumerate(self.towns)}
+        self.distance_matrix = table_array(table, self.towns, self.towns)
+        np.fill_diagonal(self.distance_matrix, 0)
+        self.options = (subtour, engine, time_limit, warm_start, solver_config(backend, 'cbc'))
+        self.processes = processes
+        if processes:
+            self.executor = ProcessPoolExecutor(max_workers= max_workers, initializer= init_route_worker, initargs= (self.distance_matrix,))
+        else:
+            self.executor = ThreadPoolExecutor(max_workers= max_workers)
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _solve(self, key):
+        # the future of the tour of a canonical town set, from the cache or a new solve
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return self._cache[key]
+            self.misses += 1
+            request = (np.array(key), *self.options)
+            if self.processes:
+                future = self.executor.submit(solve_route_request, request)
+            else:
+                future = self.executor.submit(solve_route_request, request, self.distance_matrix)
+            self._cache[key] = future
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last= False)
+        future.add_done_callback(lambda future: self._forget_failed(key, future))
+        return future
+
+    def _forget_failed(self, key, future):
+        # failed solves are not cached
+        if future.exception() is None:
+            return
+        with self._lock:
+            if self._cache.get(key) is future:
+                del self._cache[key]
+
+    def submit(self, towns):
+        # Future of the route through the towns, starting and ending at the first one, in the same form as task2's result
+        if not towns:
+            raise ValueError("A route needs at least one town")
+        indices = []
+        for town in towns:
+            if town not in self.town_index:
+                raise ValueError(f"Unknown town: {town}")
+            indices.append(self.town_index[town])
+        key = tuple(sorted(set(indices)))
+        route = Future()
+
+        def done(solved):
+            # an exception raised in a done callback is only logged, pass it on to the caller's future instead
+            try:
+                status, tour, gap, solvers = solved.result()
+                # the solvers are those of the solve that produced the tour, a cached tour keeps them
+                result = {'task': 'task2', 'parameters': {'towns_to_visit': list(towns)}, 'status': status, 'solvers': solvers}
+                if tour is not None:
+                    # the cached tour starts at its lowest town number, walk it from the first requested town instead
+                    tour = np.roll(tour, -int(np.flatnonzero(tour == indices[0])[0]))
+                    result['overall_distance'] = float(tour_length(self.distance_matrix, tour))
+                    result['gap'] = gap
+                    result['legs'] = route_legs(self.towns, self.distance_matrix, tour)
+            except Exception as error:
+                route.set_exception(error)
+                return
+            route.set_result(result)
+
+        self._solve(key).add_done_callback(done)
+        return route
+
+    def route(self, towns):
+        return self.submit(towns).result()
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'cached': len(self._cache)}
+
+    def close(self):
+        self.executor.shutdown()
 
-    timestamps = sorted(list(set([key[0] for key in usd_data.keys()])))
-    stocks = list(set([key[1] for key in usd_data.keys()])) + list(set([key[1] for key in eur_data.keys()]))
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class RouteRequestHandler(socketserver.StreamRequestHandler):
+    # One JSON object per line, {"towns": [...]} is answered with the route, {"stats": true} with the cache statistics
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError("A request has to be a JSON object")
+                if request.get('stats'):
+                    response = self.server.service.stats()
+                else:
+                    response = self.server.service.route(request['towns'])
+            except (ValueError, KeyError, TypeError) as error:
+                response = {'error': str(error)}
+            self.wfile.write((result_json(response) + '\n').encode())
+
+class RouteServer(socketserver.ThreadingTCPServer):
+    # connection threads do not keep the process alive on shutdown
+    daemon_threads = True
+    allow_reuse_address = True
+
+def serve_routes(service, host= '127.0.0.1', port= 8642):
+    # Answer route requests on a local socket until interrupted, every connection is handled in its own thread
+    with RouteServer((host, port), RouteRequestHandler) as server:
+        server.service = service
+        server.serve_forever()
+
+# the largest share of any position and the lowest average monthly reward of the task3 portfolios
+TASK3_CAP = 0.3
+TASK3_REWARD_FLOOR = 1.005
+
+def load_task3_data(currency= 'USD', xlsx_path= 'Assignment_DA_2_Task_3_data.xlsx'):
+    # Month labels, stock names and the (T, N) matrix of prices converted to the given currency
+    usd = load_table(xlsx_path, 'USD', NoneValue= np.nan)
+    eur = load_table(xlsx_path, 'EUR', NoneValue= np.nan)
+    fx = load_table(xlsx_path, 'Currency', NoneValue= np.nan)
+
+    timestamps = sorted(usd.rows)
+    usd_prices = table_array(usd, timestamps, usd.cols)
+    eur_prices = table_array(eur, timestamps, eur.cols)
+    eurusd = table_array(fx, timestamps, ['EURUSD'])
 
-    # Create a parameter to decide which currency to use
     if currency == 'USD':
-        for key, value in eur_data.items():
-            eur_data[key] = currency_data[key[0], 'EURUSD'] * value
+        eur_prices = eur_prices * eurusd
     else:
-        for key, value in usd_data.items():
-            usd_data[key] = value / currency_data[key[0], 'EURUSD']
-
-    stocks_data = {}
-    for key, value in eur_data.items():
-        stocks_data[key] = value
-    for key, value in usd_data.items():
-        stocks_data[key] = value
-    
-    # calculate the monthly return
-    return_data = {}
-    for i in range(1, len(timestamps)):
-        for stock in stocks:
-            return_data[timestamps[i], stock] = \
-                stocks_data[timestamps[i], stock] / stocks_data[timestamps[i - 1], stock]
+        usd_prices = usd_prices / eurusd
 
-    print(f"task3_A_{currency}")
+    return timestamps, usd.cols + eur.cols, np.hstack([usd_prices, eur_prices])
+
+def task3_returns(prices):
+    # monthly return of each stock, row i is the return from month i to month i + 1
+    return prices[1:] / prices[:-1]
+
+# the task3 minimum deviation LP with handles to everything a parameter sweep or a moving window changes
+DeviationModel = namedtuple('DeviationModel', ['solver', 'portfolio_vars', 'bounce_vars', 'reward_constraint',
+                                               'lower_deviation', 'upper_deviation', 'config'])
+
+def build_deviation_model(num_months, num_stocks, cap, reward_floor, backend= None):
+    # Build the minimum deviation LP for num_months months with all return coefficients left at 0,
+    # set_deviation_returns fills them in month by month
+    config = solver_config(backend, 'glop')
+    solver = create_solver(config)
+    portfolio_vars = [[solver.NumVar(0, cap, "") for j in range(num_stocks)] for i in range(num_months)]
+    bounce_vars = [solver.NumVar(0, solver.infinity(), "") for i in range(num_months)]
+
+    # the average monthly reward is at least reward_floor, multiplied through by the number of months
+    reward_constraint = solver.Constraint(reward_floor * num_months, solver.infinity())
+    lower_deviation = []
+    upper_deviation = []
+    for i in range(num_months):
+        solver.Add(sum(portfolio_vars[i]) == 1.0)
+        lower_deviation.append(solver.Constraint(0, solver.infinity()))
+        lower_deviation[i].SetCoefficient(bounce_vars[i], 1)
+        upper_deviation.append(solver.Constraint(-solver.infinity(), 0))
+        upper_deviation[i].SetCoefficient(bounce_vars[i], -1)
+
+    objective = solver.Objective()
+    for i in range(num_months):
+        objective.SetCoefficient(bounce_vars[i], 1)
+    objective.SetMinimization()
+    return DeviationModel(solver, portfolio_vars, bounce_vars, reward_constraint, lower_deviation, upper_deviation, config)
+
+def set_deviation_returns(model, i, month_returns, average_reward):
+    # set the reward and deviation coefficients of month i
+    for j, var in enumerate(model.portfolio_vars[i]):
+        model.reward_constraint.SetCoefficient(var, month_returns[j])
+        model.lower_deviation[i].SetCoefficient(var, month_returns[j] - average_reward[j])
+        model.upper_deviation[i].SetCoefficient(var, month_returns[j] - average_reward[j])
 
-    # Determine and output the overall average monthly reward for each investment position
-    average_reward_data = {}
-    for stock in stocks:
-        average_reward_data[stock] = sum([return_data[timestamp, stock] for timestamp in timestamps[1:]]) / (len(timestamps) - 1)
-        print(f"The overall average monthly reward of {stock} is {average_reward_data[stock]}")
+def solve_task3_lps(timestamps, stocks, return_data, average_reward_data, profile, config):
+    # Build and solve the market timing LP (task3_B) and the minimum deviation LP (task3_C),
+    # returns the report of each as a dict
 
     # 2. Create a Linear Program to determine the reward that optimal timing the market could have
     #achieved over the past five years using the OR Tools wrapper of the GLOP_LINEAR_PROGRAMMING solver
 
-    solver1 = pywraplp.Solver.CreateSolver("GLOP_LINEAR_PROGRAMMING")
+    with profile.phase('build'):
+        solver1 = create_solver(config)
 
-    # For each month create decision variables that indicate the percentage of each position held as well as 
-    # the percentage of cash not invested during this month 
-    percent_var = {}
-    positions = stocks + ['Cash']
-    for timestamp in timestamps:
-        for position in positions:
-            percent_var[timestamp, position] = solver1.NumVar(0, 1, "")
+        # For each month create decision variables that indicate the percentage of each position held as well as 
+        # the percentage of cash not invested during this month 
+        percent_var = {}
+        positions = stocks + ['Cash']
+        for timestamp in timestamps:
+            for position in positions:
+                percent_var[timestamp, position] = solver1.NumVar(0, 1, "")
     
-    # Identify and create the implicit constraints to ensure that the investment portfolio always adds up to 100%
-    for timestamp in timestamps:
-        solver1.Add(sum(percent_var[timestamp, position] for position in positions) == 1.0)
-
-    # Investing everything into one single position is not good practice. 
-    # Therefore, identify and create constraints that ensure that no single investment position is ever more than 30% of the overall portfolio
-    for timestamp in timestamps:
-        for position in positions:
-            solver1.Add(percent_var[timestamp, position] <= 0.3)
+        # Identify and create the implicit constraints to ensure that the investment portfolio always adds up to 100%
+        for timestamp in timestamps:
+            solver1.Add(sum(percent_var[timestamp, position] for position in positions) == 1.0)
+
+        # Investing everything into one single position is not good practice. 
+        # Therefore, identify and create constraints that ensure that no single investment position is ever more than 30% of the overall portfolio
+        for timestamp in timestamps:
+            for position in positions:
+                solver1.Add(percent_var[timestamp, position] <= TASK3_CAP)
     
-    # Identify and implement an objective function that maximises the overall reward of the portfolio by summing all respective monthly returns
-    return_vars = {}
-    for timestamp in timestamps[1:]:
-        return_vars[timestamp] = sum(percent_var[timestamp, stock] * return_data[timestamp, stock] for stock in stocks)
+        # Identify and implement an objective function that maximises the overall reward of the portfolio by summing all respective monthly returns
+        return_vars = {}
+        for timestamp in timestamps[1:]:
+            return_vars[timestamp] = sum(percent_var[timestamp, stock] * return_data[timestamp, stock] for stock in stocks)
 
-    solver1.Maximize(sum(return_vars[timestamp] for timestamp in timestamps[1:]))
+        solver1.Maximize(sum(return_vars[timestamp] for timestamp in timestamps[1:]))
 
-    status = solver1.Solve()
+    with profile.phase('solve'):
+        status, solve_time = run_solver(solver1, config)
+    profile.add_solver('task3_B', solver_stats(solver1, status, config, solve_time))
 
-    if status == pywraplp.Solver.OPTIMAL:
-        print("Task3_B", currency)
-        with open(f"task3_B_{currency}.csv", "a", newline= "") as f:
-            csvwriter = csv.writer(f)
-            csvwriter.writerow([None] + positions)
-            for timestamp in timestamps:
-                csvwriter.writerow([timestamp[:7]] + [round(percent_var[timestamp, position].solution_value() * 100.0, 2) for position in positions])
-            
-        print("Overall Average Monthly Reward: ", solver1.Objective().Value() / (len(timestamps) - 1))
+    with profile.phase('report'):
+        timing = {'status': STATUS_NAMES.get(status, str(status))}
+        if status == pywraplp.Solver.OPTIMAL:
+            timing['positions'] = positions
+            timing['allocation'] = [[timestamp[:7]] + [round(percent_var[timestamp, position].solution_value() * 100.0, 2) for position in positions]
+                                              for timestamp in timestamps]
+            timing['average_reward'] = solver1.Objective().Value() / (len(timestamps) - 1)
 
 
 
     # 3. Create another Linear Program to determine such an optimal portfolio that minimises the investment risk
 
-    solver2 = pywraplp.Solver.CreateSolver("GLOP_LINEAR_PROGRAMMING")
+    with profile.phase('build'):
+        solver2 = create_solver(config)
 
-    # Create decision variables that indicate the percentage of each position held in the portfolio during the entire investment period
-    portfolio_vars = {}
-    for timestamp in timestamps:
-        for stock in stocks:
-            portfolio_vars[timestamp, stock] = solver2.NumVar(0, 1, "")
+        # Create decision variables that indicate the percentage of each position held in the portfolio during the entire investment period
+        portfolio_vars = {}
+        for timestamp in timestamps:
+            for stock in stocks:
+                portfolio_vars[timestamp, stock] = solver2.NumVar(0, 1, "")
     
-    # Create the implicit constraint that the investment portfolio always adds up to 100%
-    for timestamp in timestamps:
-        solver2.Add(sum(portfolio_vars[timestamp, stock] for stock in stocks) == 1.0)
+        # Create the implicit constraint that the investment portfolio always adds up to 100%
+        for timestamp in timestamps:
+            solver2.Add(sum(portfolio_vars[timestamp, stock] for stock in stocks) == 1.0)
     
-    # Identify and create constraints to ensure that no single investment position is ever more than 30% of the overall portfolio
-    for timestamp in timestamps:
-        for stock in stocks:
-            solver2.Add(portfolio_vars[timestamp, stock] <= 0.3)
+        # Identify and create constraints to ensure that no single investment position is ever more than 30% of the overall portfolio
+        for timestamp in timestamps:
+            for stock in stocks:
+                solver2.Add(portfolio_vars[timestamp, stock] <= TASK3_CAP)
     
-    # Create a constraint to ensure that the overall average monthly reward of the portfolio is 
-    # at least 0.5% over the five-year investment period
-    solver2.Add(sum(sum(portfolio_vars[timestamp, stock] * return_data[timestamp, stock] for stock in stocks) for timestamp in timestamps[1:])\
-                    / (len(timestamps) - 1) >= 1.005)
-
-    # Create these additional variables
-    bounce_vars = {}
-    for timestamp in timestamps[1:]:
-        bounce_vars[timestamp] = solver2.NumVar(0, solver2.infinity(), "")
+        # Create a constraint to ensure that the overall average monthly reward of the portfolio is 
+        # at least 0.5% over the five-year investment period
+        solver2.Add(sum(sum(portfolio_vars[timestamp, stock] * return_data[timestamp, stock] for stock in stocks) for timestamp in timestamps[1:])\
+                        / (len(timestamps) - 1) >= TASK3_REWARD_FLOOR)
+
+        # Create these additional variables
+        bounce_vars = {}
+        for timestamp in timestamps[1:]:
+            bounce_vars[timestamp] = solver2.NumVar(0, solver2.infinity(), "")
     
-    # implement the necessary constraints for bounding the deviation
-    for timestamp in timestamps[1:]:
-        solver2.Add(sum(portfolio_vars[timestamp, stock] * (return_data[timestamp, stock] - average_reward_data[stock]) for stock in stocks) \
-                    >= -bounce_vars[timestamp])
-        solver2.Add(sum(portfolio_vars[timestamp, stock] * (return_data[timestamp, stock] - average_reward_data[stock]) for stock in stocks) \
-                    <= bounce_vars[timestamp])
+        # implement the necessary constraints for bounding the deviation
+        for timestamp in timestamps[1:]:
+            solver2.Add(sum(portfolio_vars[timestamp, stock] * (return_data[timestamp, stock] - average_reward_data[stock]) for stock in stocks) \
+                        >= -bounce_vars[timestamp])
+            solver2.Add(sum(portfolio_vars[timestamp, stock] * (return_data[timestamp, stock] - average_reward_data[stock]) for stock in stocks) \
+                        <= bounce_vars[timestamp])
+
+        solver2.Minimize(sum(bounce_vars[timestamp] for timestamp in timestamps[1:]))
+
+    with profile.phase('solve'):
+        status, solve_time = run_solver(solver2, config)
+    profile.add_solver('task3_C', solver_stats(solver2, status, config, solve_time))
 
-    solver2.Minimize(sum(bounce_vars[timestamp] for timestamp in timestamps[1:]))
+    with profile.phase('report'):
+        deviation = {'status': STATUS_NAMES.get(status, str(status))}
+        if status == pywraplp.Solver.OPTIMAL:
+            deviation['positions'] = stocks
+            deviation['allocation'] = [[timestamp[:7]] + [round(portfolio_vars[timestamp, stock].solution_value() * 100.0, 2) for stock in stocks]
+                                                 for timestamp in timestamps]
+            deviation['average_reward'] = sum(sum(portfolio_vars[timestamp, stock].solution_value() * return_data[timestamp, stock] for stock in stocks) \
+                                                        for timestamp in timestamps[1:]) / (len(timestamps) - 1)
+
+    return timing, deviation
+
+def task3(currency= 'USD', xlsx_path= 'Assignment_DA_2_Task_3_data.xlsx', profile= None, verbose= True, backend= None):
+    # Solve both task3 LPs and return the result as a dict, verbose prints the report and writes the csv files.
+    # backend is the SolverConfig or backend name of both LPs, GLOP by default
+    profile = profile if profile is not None else Profile()
+    config = solver_config(backend, 'glop')
+    result = {'task': 'task3', 'parameters': {'currency': currency, 'xlsx_path': xlsx_path, 'backend': config._asdict()}}
+
+    with profile.phase('load'):
+        # 1. Load the xlsx file, with the prices of every stock converted to the chosen currency
+        timestamps, stocks, prices = load_task3_data(currency, xlsx_path)
+    
+        # calculate the monthly return
+        return_data = table_dict(Table(task3_returns(prices), timestamps[1:], stocks, None))
+
+    with profile.phase('report'):
+        # Determine the overall average monthly reward for each investment position
+        average_reward_data = {}
+        for stock in stocks:
+            average_reward_data[stock] = sum([return_data[timestamp, stock] for timestamp in timestamps[1:]]) / (len(timestamps) - 1)
+        result['average_reward'] = average_reward_data
+
+    # 2. and 3. are the same linear programs for every run on the same prices
+    key = data_key('task3', currency, TASK3_CAP, TASK3_REWARD_FLOOR, config, timestamps, stocks, prices)
+    cached = load_result(key)
+    if cached is not None:
+        timing, deviation = cached['timing'], cached['deviation']
+    else:
+        timing, deviation = solve_task3_lps(timestamps, stocks, return_data, average_reward_data, profile, config)
+        if definitive(timing['status'], config.time_limit) and definitive(deviation['status'], config.time_limit):
+            store_result(key, {'timing': timing, 'deviation': deviation})
 
-    status = solver2.Solve()
+    with profile.phase('report'):
+        result['timing'] = timing
+        result['deviation'] = deviation
+        result['cached'] = cached is not None
 
+        if verbose:
+            print_task3_report(result)
 
-    if status == pywraplp.Solver.OPTIMAL:
+    result['profile'] = profile.as_dict()
+    return result
+
+def print_task3_report(result):
+    currency = result['parameters']['currency']
+    print(f"task3_A_{currency}")
+    for stock, average_reward in result['average_reward'].items():
+        print(f"The overall average monthly reward of {stock} is {average_reward}")
+
+    if result['timing']['status'] == 'optimal':
+        print("Task3_B", currency)
+        write_csv(f"task3_B_{currency}.csv", [None] + result['timing']['positions'], result['timing']['allocation'])
+
+        print("Overall Average Monthly Reward: ", result['timing']['average_reward'])
+
+    if result['deviation']['status'] == 'optimal':
         print("Task3_C", currency)
-        with open(f"task3_C_{currency}.csv", "a", newline= "") as f:
-            csvwriter = csv.writer(f)
-            csvwriter.writerow([None] + stocks)
-            for timestamp in timestamps:
-                csvwriter.writerow([timestamp[:7]] + [round(portfolio_vars[timestamp, stock].solution_value() * 100.0, 2) for stock in stocks])
-                # print(f"In {timestamp[:7]}")
-                # print(", ".join([f"{stock}: {portfolio_vars[timestamp, stock].solution_value() * 100.0:.2f}%" for stock in stocks]))
-        
-        print("Overall Average Monthly Reward: ", sum(sum(portfolio_vars[timestamp, stock].solution_value() * return_data[timestamp, stock] for stock in stocks) \
-                  for timestamp in timestamps[1:]) / (len(timestamps) - 1))
+        write_csv(f"task3_C_{currency}.csv", [None] + result['deviation']['positions'], result['deviation']['allocation'])
+
+        print("Overall Average Monthly Reward: ", result['deviation']['average_reward'])
     else:
         print("This problem has no optimal solution")
     
     print("\n\n")
     
+def count_csv_rows(path):
+    # number of data rows of a csv file, counted in binary blocks without parsing
+    with open(path, 'rb') as f:
+        lines = sum(block.count(b'\n') for block in iter(lambda: f.read(1 << 20), b''))
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) != b'\n':
+            lines += 1
+    return lines - 1
+
+# an empty csv field, followed by a delimiter or the end of the line
+EMPTY_FIELD = re.compile(r',(?=[,\r\n]|$)')
+
+def open_price_file(path):
+    # Column names, number of rows and a function that iterates over the (dates, values) chunks of at most
+    # chunk_rows rows of a wide price file: the first column holds the dates, every other column the prices
+    # of one asset, empty cells are NaN. .parquet files are read with pyarrow, anything else as csv, parsed by
+    # np.loadtxt in C after the empty fields of the chunk are turned into nan.
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        parquet_file = pq.ParquetFile(path)
+        names = parquet_file.schema_arrow.names
+
+        def chunks(chunk_rows):
+            for batch in parquet_file.iter_batches(batch_size= chunk_rows):
+                dates = [str(date) for date in batch.column(0).to_pylist()]
+                values = np.column_stack([batch.column(j).to_numpy(zero_copy_only= False).astype(np.float64)
+                                          for j in range(1, batch.num_columns)])
+                yield dates, values
+        return names[1:], parquet_file.metadata.num_rows, chunks
+
+    num_rows = count_csv_rows(path)
+    with open(path, newline= '') as f:
+        names = next(csv.reader(f))
+
+    def chunks(chunk_rows):
+        with open(path, newline= '') as f:
+            next(f)
+            while True:
+                lines = list(islice(f, chunk_rows))
+                if not lines:
+                    return
+                dates = [line.split(',', 1)[0] for line in lines]
+                lines = [EMPTY_FIELD.sub(',nan', line) for line in lines]
+                values = np.loadtxt(lines, delimiter= ',', usecols= range(1, len(names)), dtype= np.float64, ndmin= 2)
+                yield dates, values
+    return names[1:], num_rows, chunks
+
+def fill_forward(values, last):
+    # replace the NaN of each column by the last price before it, last is the last row of the previous chunk
+    block = np.vstack([last[None, :], values])
+    index = np.where(np.isnan(block), 0, np.arange(len(block))[:, None])
+    np.maximum.accumulate(index, axis= 0, out= index)
+    return block[index, np.arange(block.shape[1])][1:]
+
+def load_task3_stream(usd_path, eur_path, fx_path, array_path, currency= 'USD', chunk_cells= 2 ** 18):
+    # Streaming version of load_task3_data for large daily price drops. The USD, EUR and EURUSD files are read
+    # together a chunk of rows at a time, as many rows as keep the cells of the three files within chunk_cells,
+    # converted to the chosen currency and written straight into a (T, N) float64
+    # array memory-mapped from the .npy file at array_path, USD columns first. The three files need the same dates
+    # in ascending order, a gap in a price series is filled with the last price before it.
+    # The array is then turned into returns in place, row i is the return from day i to day i + 1.
+    # Returns the dates, the asset names and the (T - 1, N) view of the returns.
+    usd_assets, num_rows, usd_chunks = open_price_file(usd_path)
+    eur_assets, eur_rows, eur_chunks = open_price_file(eur_path)
+    fx_columns, fx_rows, fx_chunks = open_price_file(fx_path)
+    if not num_rows == eur_rows == fx_rows:
+        raise ValueError(f"The price files have different numbers of rows: {num_rows}, {eur_rows} and {fx_rows}")
+    if 'EURUSD' not in fx_columns:
+        raise ValueError(f"{fx_path} has no EURUSD column")
+    if num_rows < 2:
+        raise ValueError("At least two days of prices are needed for returns")
+    fx_column = fx_columns.index('EURUSD')
+    num_usd = len(usd_assets)
+    assets = usd_assets + eur_assets
+    chunk_rows = max(1, chunk_cells // (len(assets) + len(fx_columns)))
+
+    prices = np.lib.format.open_memmap(array_path, mode= 'w+', dtype= np.float64, shape= (num_rows, len(assets)))
+    dates = []
+    last_usd = np.full(num_usd, np.nan)
+    last_eur = np.full(len(eur_assets), np.nan)
+    last_fx = np.full(1, np.nan)
+    start = 0
+    for (usd_dates, usd), (eur_dates, eur), (fx_dates, fx) in zip(usd_chunks(chunk_rows), eur_chunks(chunk_rows), fx_chunks(chunk_rows)):
+        if usd_dates != eur_dates or usd_dates != fx_dates:
+            raise ValueError(f"The price files have different dates after {dates[-1] if dates else 'the header'}")
+        if dates and usd_dates[0] <= dates[-1] or usd_dates != sorted(usd_dates):
+            raise ValueError(f"The dates are not in ascending order after {dates[-1] if dates else 'the header'}")
+        usd = fill_forward(usd, last_usd)
+        eur = fill_forward(eur, last_eur)
+        fx = fill_forward(fx[:, fx_column:fx_column + 1], last_fx)
+        last_usd, last_eur, last_fx = usd[-1], eur[-1], fx[-1]
+
+        end = start + len(usd_dates)
+        if currency == 'USD':
+            prices[start:end, :num_usd] = usd
+            np.multiply(eur, fx, out= prices[start:end, num_usd:])
+        else:
+            np.divide(usd, fx, out= prices[start:end, :num_usd])
+            prices[start:end, num_usd:] = eur
+        if start == 0 and np.isnan(prices[0]).any():
+            raise ValueError(f"{assets[int(np.isnan(prices[0]).argmax())]} has no price on the first day")
+        dates.extend(usd_dates)
+        start = end
+
+    # prices[i] / prices[i - 1], a block at a time from the top so every price is read before it is overwritten
+    for start in range(0, num_rows - 1, chunk_rows):
+        end = min(start + chunk_rows, num_rows - 1)
+        np.divide(prices[start + 1:end + 1], prices[start:end], out= prices[start:end])
+    prices.flush()
+    return dates, assets, prices[:-1]
+
+def build_timing_matrix(returns, cap):
+    # The market timing LP of task3_B on a (T, N) returns array. The variables are laid out as (T, N + 1)
+    # with the cash position last, one constraint row per period keeps the portfolio at 100%.
+    T, N = returns.shape
+    num_vars = T * (N + 1)
+    objective = np.zeros((T, N + 1))
+    objective[:, :N] = returns
+    constraint_matrix = scipy_sparse.csr_matrix((np.ones(num_vars), np.arange(num_vars), np.arange(0, num_vars + 1, N + 1)),
+                                                shape= (T, num_vars))
+    model = mbh.ModelBuilderHelper()
+    model.fill_model_from_sparse_data(np.zeros(num_vars), np.full(num_vars, cap), objective.ravel(),
+                                      np.ones(T), np.ones(T), constraint_matrix)
+    model.set_maximize(True)
+    return model
+
+def build_deviation_matrix(returns, cap, reward_floor):
+    # The minimum deviation LP of task3_C on a (T, N) returns array. The variables are the (T, N) portfolio
+    # followed by the T bounce variables, the rows are the 100% rows, the average reward row and the lower
+    # and upper deviation rows of each period, as in build_deviation_model.
+    T, N = returns.shape
+    portfolio = np.arange(T * N).reshape(T, N)
+    bounce = T * N + np.arange(T)
+    deviation = returns - returns.mean(axis= 0)
+    deviation_index = np.column_stack([portfolio, bounce]).ravel()
+
+    indices = np.concatenate([portfolio.ravel(), portfolio.ravel(), deviation_index, deviation_index])
+    coefs = np.concatenate([np.ones(T * N), returns.ravel(),
+                            np.column_stack([deviation, np.ones(T)]).ravel(), np.column_stack([deviation, -np.ones(T)]).ravel()])
+    row_lengths = np.concatenate([np.full(T, N), [T * N], np.full(2 * T, N + 1)])
+    constraint_matrix = scipy_sparse.csr_matrix((coefs, indices, np.concatenate([[0], np.cumsum(row_lengths)])),
+                                                shape= (3 * T + 1, T * N + T))
+    lower = np.concatenate([np.ones(T), [reward_floor * T], np.zeros(T), np.full(T, -np.inf)])
+    upper = np.concatenate([np.ones(T), [np.inf], np.full(T, np.inf), np.zeros(T)])
+
+    model = mbh.ModelBuilderHelper()
+    model.fill_model_from_sparse_data(np.zeros(T * N + T), np.concatenate([np.full(T * N, cap), np.full(T, np.inf)]),
+                                      np.concatenate([np.zeros(T * N), np.ones(T)]), lower, upper, constraint_matrix)
+    return model
+
+def allocation_rows(dates, allocation):
+    # csv rows of an allocation array in percent, generated one period at a time
+    for date, row in zip(dates, allocation):
+        yield [date[:10]] + np.round(row * 100.0, 2).tolist()
+
+def task3_stream(usd_path, eur_path, fx_path, array_path, currency= 'USD', cap= TASK3_CAP, reward_floor= TASK3_REWARD_FLOOR, chunk_cells= 2 ** 18,
+                 profile= None, backend= None, report_dir= None):
+    # Both task3 LPs on large price files streamed through load_task3_stream, built straight from the returns
+    # array with the model builder. The result has the same parts as task3's with arrays in place of the
+    # per stock dicts and allocation lists, row i of an allocation is held for the return of row i, from dates[i] to dates[i + 1].
+    # report_dir writes the allocations as task3_B_{currency}.csv and task3_C_{currency}.csv.
+    profile = profile if profile is not None else Profile()
+    config = solver_config(backend, 'glop')
+    result = {'task': 'task3', 'parameters': {'currency': currency, 'usd_path': usd_path, 'eur_path': eur_path, 'fx_path': fx_path,
+                                              'cap': cap, 'reward_floor': reward_floor, 'backend': config._asdict()}}
+
+    with profile.phase('load'):
+        dates, assets, returns = load_task3_stream(usd_path, eur_path, fx_path, array_path, currency, chunk_cells)
+        T, N = returns.shape
+        result['assets'] = assets
+        result['average_reward'] = returns.mean(axis= 0)
+
+    for name, part, build in [('task3_B', 'timing', lambda: build_timing_matrix(returns, cap)),
+                              ('task3_C', 'deviation', lambda: build_deviation_matrix(returns, cap, reward_floor))]:
+        with profile.phase('build'):
+            model = build()
+        with profile.phase('solve'):
+            solver = create_model_solver(config)
+            solve_time = run_model_solver(solver, model)
+        profile.add_solver(name, model_solver_stats(model, solver, config, solve_time))
+
+        with profile.phase('report'):
+            result[part] = {'status': solver.status().name.lower()}
+            if solver.status() == mbh.SolveStatus.OPTIMAL:
+                values = solver.variable_values()
+                if part == 'timing':
+                    allocation = values[:T * (N + 1)].reshape(T, N + 1)
+                    result[part]['positions'] = assets + ['Cash']
+                    result[part]['average_reward'] = solver.objective_value() / T
+                else:
+                    allocation = values[:T * N].reshape(T, N)
+                    result[part]['positions'] = assets
+                    result[part]['average_reward'] = float((allocation * returns).sum() / T)
+                result[part]['allocation'] = allocation
+                if report_dir is not None:
+                    os.makedirs(report_dir, exist_ok= True)
+                    write_csv(os.path.join(report_dir, f"{name}_{currency}.csv"), [None] + result[part]['positions'],
+                              allocation_rows(dates[1:], allocation))
+
+    result['profile'] = profile.as_dict()
+    return result
+
+def backtest_task3(currency= 'USD', window= 36, step= 1, cap= TASK3_CAP, reward_floor= TASK3_REWARD_FLOOR, csv_path= None, backend= None):
+    # Re-solve both task3 LPs on a sliding window of `window` monthly returns, advancing `step` months at a time.
+    # The models hold one slot of variables and constraints per month of the window. Moving the window
+    # hands the slot of the oldest month to the newest one by rewriting its coefficients, so the models are
+    # never rebuilt and GLOP re-solves from the previous basis.
+    # Returns the header and rows of one table with the allocation of every month of every window,
+    # each row ends with the status, backend and time of the solve it comes from.
+    timestamps, stocks, prices = load_task3_data(currency)
+    returns = task3_returns(prices)
+    months = [timestamp[:7] for timestamp in timestamps[1:]]
+    num_stocks = len(stocks)
+    positions = stocks + ['Cash']
+    if not 0 < window <= len(returns):
+        raise ValueError(f"The window has to be between 1 and {len(returns)} months")
+
+    # market timing model, the slot of month i is i % window
+    config = solver_config(backend, 'glop')
+    solver1 = create_solver(config)
+    percent_var = [[solver1.NumVar(0, cap, "") for position in positions] for slot in range(window)]
+    for slot in range(window):
+        solver1.Add(sum(percent_var[slot]) == 1.0)
+    objective1 = solver1.Objective()
+    objective1.SetMaximization()
+
+    # minimum deviation model
+    model2 = build_deviation_model(window, num_stocks, cap, reward_floor, config)
+    solver2, portfolio_vars = model2.solver, model2.portfolio_vars
+    objective2 = solver2.Objective()
+
+    def set_month(i):
+        slot = i % window
+        for j in range(num_stocks):
+            objective1.SetCoefficient(percent_var[slot][j], returns[i, j])
+
+    def set_deviation(start):
+        average_reward = returns[start:start + window].mean(axis= 0)
+        for i in range(start, start + window):
+            set_deviation_returns(model2, i % window, returns[i], average_reward)
+
+    header = ['window_end', 'model', 'month', 'objective', 'average_reward'] + positions + STATS_HEADER
+    rows = []
+    for i in range(window):
+        set_month(i)
+
+    for start in range(0, len(returns) - window + 1, step):
+        if start > 0:
+            for i in range(max(start, start - step + window), start + window):
+                set_month(i)
+        set_deviation(start)
+        window_end = months[start + window - 1]
+
+        status, solve_time = run_solver(solver1, config)
+        stats = stats_columns(solver_stats(solver1, status, config, solve_time))
+        if status == pywraplp.Solver.OPTIMAL:
+            average_reward = objective1.Value() / window
+            for i in range(start, start + window):
+                rows.append([window_end, 'B', months[i], objective1.Value(), average_reward] +
+                            [round(var.solution_value() * 100.0, 2) for var in percent_var[i % window]] + stats)
+        else:
+            rows.append([window_end, 'B', None, None, None] + [None] * len(positions) + stats)
+
+        status, solve_time = run_solver(solver2, config)
+        stats = stats_columns(solver_stats(solver2, status, config, solve_time))
+        if status == pywraplp.Solver.OPTIMAL:
+            average_reward = float(sum(portfolio_vars[i % window][j].solution_value() * returns[i, j]
+                                       for i in range(start, start + window) for j in range(num_stocks)) / window)
+            for i in range(start, start + window):
+                rows.append([window_end, 'C', months[i], objective2.Value(), average_reward] +
+                            [round(var.solution_value() * 100.0, 2) for var in portfolio_vars[i % window]] + [0.0] + stats)
+        else:
+            rows.append([window_end, 'C', None, None, None] + [None] * len(positions) + stats)
+
+    if csv_path is not None:
+        write_csv(csv_path, header, rows)
+    return header, rows
+    
+# the returns of each currency, the solver backend and the deviation model of each currency of a frontier worker process
+_frontier_returns = None
+_frontier_backend = None
+_frontier_models = {}
+
+def init_frontier_worker(returns, backend= None):
+    global _frontier_returns, _frontier_backend
+    _frontier_returns = returns
+    _frontier_backend = backend
+    _frontier_models.clear()
+
+def solve_frontier_point(point):
+    # Solve the minimum deviation LP for one (currency, reward floor, cap) point. The model of a currency is
+    # built once per worker, later points only change the reward floor and the position bounds.
+    currency, reward_floor, cap = point
+    returns = _frontier_returns[currency]
+    num_months, num_stocks = returns.shape
+    if currency not in _frontier_models:
+        model = build_deviation_model(num_months, num_stocks, cap, reward_floor, _frontier_backend)
+        average_reward = returns.mean(axis= 0)
+        for i in range(num_months):
+            set_deviation_returns(model, i, returns[i], average_reward)
+        _frontier_models[currency] = model
+
+    model = _frontier_models[currency]
+    model.reward_constraint.SetLb(reward_floor * num_months)
+    for month_vars in model.portfolio_vars:
+        for var in month_vars:
+            var.SetUb(cap)
+
+    status, solve_time = run_solver(model.solver, model.config)
+    stats = stats_columns(solver_stats(model.solver, status, model.config, solve_time))
+    if status != pywraplp.Solver.OPTIMAL:
+        return [currency, reward_floor, cap, None, None] + stats
+    allocation = np.array([[var.solution_value() for var in month_vars] for month_vars in model.portfolio_vars])
+    return [currency, reward_floor, cap, model.solver.Objective().Value(), float((allocation * returns).sum() / num_months)] + stats
+
+def task3_frontier(reward_floors, caps, currencies= ('USD', 'EUR'), max_workers= None, csv_path= None, backend= None):
+    # Sweep the risk/reward frontier of the task3 minimum deviation LP over the grid of average monthly
+    # reward floors and position caps for each currency. The returns are computed once here and sent to
+    # each worker when the pool starts. Returns the header and one row per grid point with the
+    # objective (total absolute deviation) and the achieved average monthly reward, None if infeasible,
+    # followed by the status, backend and time of the solve.
+    returns = {currency: task3_returns(load_task3_data(currency)[2]) for currency in currencies}
+    points = [(currency, float(reward_floor), float(cap)) for currency in currencies for cap in caps for reward_floor in reward_floors]
+    header = ['currency', 'reward_floor', 'cap', 'objective', 'average_reward'] + STATS_HEADER
+
+    if max_workers == 1 or len(points) < 2:
+        init_frontier_worker(returns, backend)
+        rows = [solve_frontier_point(point) for point in points]
+    else:
+        max_workers = min(max_workers or os.cpu_count(), len(points))
+        # contiguous chunks keep neighbouring points, and so similar bases, on the same worker
+        chunksize = max(1, -(-len(points) // max_workers))
+        with ProcessPoolExecutor(max_workers= max_workers, initializer= init_frontier_worker, initargs= (returns, backend)) as executor:
+            rows = list(executor.map(solve_frontier_point, points, chunksize= chunksize))
+
+    if csv_path is not None:
+        write_csv(csv_path, header, rows)
+    return header, rows
+    
 if __name__ == '__main__':
     task1()
     task2()